@@ -2,6 +2,11 @@ import os
 import re
 import argparse
 import sys
+import json
+import shutil
+import hashlib
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 """
 This script updates environment variables in a .env file with values from the local environment.
@@ -26,45 +31,247 @@ Usage:
 3. Run the script, specifying the input and output file paths.
    Example:
    python update_env.py input.env output.env
+
+Batch mode:
+   To render many .env files in one run, list "input output" pairs (one per line, relative
+   to the manifest, "#" for comments) in a manifest file:
+   api/.env.template          api/.env
+   vertex-proxy/.env.template vertex-proxy/.env
+
+   python update_env.py --manifest env.manifest
+
+   Files are processed concurrently (--jobs) and every output is written atomically.
+   Missing variables are reported for all files at once, and nothing is written if any
+   are missing. Outputs whose input and referenced environment values are unchanged
+   since the last run are skipped, using a content-hash cache (--cache, or --no-cache).
 """
 
-def read_env_file(file_path):
-    """Reads the .env file and returns the lines as a list."""
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
-    return lines
+# Regex pattern to match lines ending with "GET_FROM_LOCAL_ENV"
+ENV_VAR_PATTERN = re.compile(r'^\s*([A-Z_]+)=GET_FROM_LOCAL_ENV\s*$')
+
+CACHE_FILE_NAME = '.update_env_cache.json'
 
 def write_env_file(file_path, lines):
-    """Writes the updated lines to the specified .env file."""
-    with open(file_path, 'w') as file:
-        file.writelines(lines)
+    """Writes the updated lines to the specified .env file atomically."""
+    temp_path = temp_path_for(file_path)
+    try:
+        with open(temp_path, 'x') as file:
+            file.writelines(lines)
+        commit_env_file(temp_path, file_path)
+    except BaseException:
+        discard_env_file(temp_path)
+        raise
 
-def update_env_file_with_local_env(input_file_path, output_file_path):
+def temp_path_for(file_path):
+    """Returns a unique temporary path in the same directory as file_path (so os.replace is atomic)."""
+    return f'{file_path}.{uuid.uuid4().hex}.tmp'
+
+def commit_env_file(temp_path, file_path):
+    """Flushes a rendered temporary file to disk and atomically moves it into place."""
+    if os.path.exists(file_path):
+        shutil.copymode(file_path, temp_path)
+    with open(temp_path, 'rb') as file:
+        os.fsync(file.fileno())
+    os.replace(temp_path, file_path)
+
+def discard_env_file(temp_path):
+    """Removes a rendered temporary file, if there is one."""
+    if temp_path and os.path.exists(temp_path):
+        os.remove(temp_path)
+
+def render_env_file(input_file_path, output_file_path):
     """
-    Reads the input .env file, updates the variables set to GET_FROM_LOCAL_ENV
-    with values from the local environment, and writes the result to the output .env file.
+    Streams the input .env file line by line into a temporary file next to the output,
+    replacing the variables set to GET_FROM_LOCAL_ENV with values from the local environment.
+
+    Returns a tuple (temp_path, updated_vars, missing_vars). If any variables are missing,
+    the temporary file is removed and temp_path is None.
     """
-    lines = read_env_file(input_file_path)
-    updated_lines = []
-    # Regex pattern to match lines ending with "GET_FROM_LOCAL_ENV"
-    env_var_pattern = re.compile(r'^\s*([A-Z_]+)=GET_FROM_LOCAL_ENV\s*$')
+    temp_path = temp_path_for(output_file_path)
     missing_vars = []
     updated_vars = []
 
-    for line in lines:
-        match = env_var_pattern.match(line)
-        if match:
-            key = match.group(1)
-            # Check if the environment variable is set in the local environment
-            if key in os.environ:
-                new_value = os.environ[key]
-                updated_line = f'{key}={new_value}\n'
-                updated_lines.append(updated_line)
-                updated_vars.append(key)
-            else:
-                missing_vars.append(key)
-        else:
-            updated_lines.append(line)
+    try:
+        with open(input_file_path, 'r') as input_file, open(temp_path, 'x') as output_file:
+            for line in input_file:
+                match = ENV_VAR_PATTERN.match(line)
+                if not match:
+                    output_file.write(line)
+                    continue
+
+                key = match.group(1)
+                # Check if the environment variable is set in the local environment
+                if key in os.environ:
+                    output_file.write(f'{key}={os.environ[key]}\n')
+                    updated_vars.append(key)
+                else:
+                    missing_vars.append(key)
+    except BaseException:
+        discard_env_file(temp_path)
+        raise
+
+    if missing_vars:
+        discard_env_file(temp_path)
+        temp_path = None
+
+    return temp_path, updated_vars, missing_vars
+
+def file_sha256(file_path):
+    """Returns the SHA-256 of a file's content, or None if it does not exist."""
+    if not os.path.exists(file_path):
+        return None
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def env_sha256(variables):
+    """Returns the SHA-256 of the current values of the given environment variables."""
+    digest = hashlib.sha256()
+    for key in sorted(variables):
+        value = os.environ.get(key)
+        digest.update(key.encode() + (b'\0' + value.encode() if value is not None else b'\1') + b'\0')
+    return digest.hexdigest()
+
+def is_unchanged(input_file_path, output_file_path, cache_entry):
+    """
+    Checks a cache entry against the input file, the environment values it references
+    and the output file, so an output is only skipped if rendering it would give the same result.
+    """
+    if not cache_entry or cache_entry.get('input') != input_file_path:
+        return False
+    return (
+        cache_entry.get('input_sha256') == file_sha256(input_file_path)
+        and cache_entry.get('env_sha256') == env_sha256(cache_entry.get('variables', []))
+        and cache_entry.get('output_sha256') == file_sha256(output_file_path)
+    )
+
+def read_manifest(manifest_path):
+    """
+    Reads a manifest of "input output" pairs, one per line.
+    Relative paths are resolved against the manifest's directory.
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    pairs = []
+    outputs = set()
+
+    with open(manifest_path, 'r') as file:
+        for line_number, line in enumerate(file, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split()
+            if len(parts) != 2:
+                raise ValueError(f'{manifest_path}:{line_number}: expected "input output", got "{line}"')
+
+            input_path, output_path = (os.path.normpath(os.path.join(base_dir, part)) for part in parts)
+            if output_path in outputs:
+                raise ValueError(f'{manifest_path}:{line_number}: output {output_path} is listed more than once')
+            outputs.add(output_path)
+            pairs.append((input_path, output_path))
+
+    return pairs
+
+def read_cache(cache_path):
+    """Reads the content-hash cache, returning an empty cache if it is missing or unreadable."""
+    try:
+        with open(cache_path, 'r') as file:
+            cache = json.load(file)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def update_env_files_from_manifest(manifest_path, jobs=8, cache_path=None):
+    """
+    Renders every input/output pair listed in the manifest concurrently.
+
+    All files are rendered to temporary files first. If any variables are missing or any input
+    cannot be read, they are reported for every file and nothing is written; otherwise all outputs
+    are moved into place. Rendered files that were not moved into place are always removed.
+    Outputs that are unchanged according to the cache at cache_path are skipped (no cache if None).
+    """
+    pairs = read_manifest(manifest_path)
+    cache = read_cache(cache_path) if cache_path else {}
+
+    def process(pair):
+        input_file_path, output_file_path = pair
+        try:
+            if is_unchanged(input_file_path, output_file_path, cache.get(output_file_path)):
+                return None
+            return render_env_file(input_file_path, output_file_path) + (None,)
+        except (OSError, UnicodeError) as e:
+            # Reported together with the missing variables instead of aborting the other files
+            return None, [], [], f'{input_file_path}: {e}'
+
+    written = 0
+    committed = set()
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        futures = [executor.submit(process, pair) for pair in pairs]
+        try:
+            results = [future.result() for future in futures]
+
+            # Report all missing variables and unreadable files across every file before writing anything
+            missing_files = {}
+            errors = []
+            for (input_file_path, _), result in zip(pairs, results):
+                if result and result[2]:
+                    for var in result[2]:
+                        missing_files.setdefault(var, []).append(input_file_path)
+                if result and result[3]:
+                    errors.append(result[3])
+
+            if missing_files or errors:
+                for error in errors:
+                    print(f"Error: could not render {error}")
+                for var, files in missing_files.items():
+                    print(f"Warning: {var} set to GET_FROM_LOCAL_ENV in {', '.join(files)}, could not find {var}, please set {var} in your local environment and run again.")
+                sys.exit(1)
+
+            for (input_file_path, output_file_path), result in zip(pairs, results):
+                if result is None:
+                    print(f"Unchanged: {output_file_path}")
+                    continue
+
+                temp_path, updated_vars, _, _ = result
+                try:
+                    commit_env_file(temp_path, output_file_path)
+                except OSError as e:
+                    print(f"Error: could not write {output_file_path}: {e}")
+                    sys.exit(1)
+                committed.add(temp_path)
+                written += 1
+                variables = sorted(set(updated_vars))
+                cache[output_file_path] = {
+                    'input': input_file_path,
+                    'input_sha256': file_sha256(input_file_path),
+                    'variables': variables,
+                    'env_sha256': env_sha256(variables),
+                    'output_sha256': file_sha256(output_file_path)
+                }
+                print(f"Processed {input_file_path} and wrote updates to {output_file_path} ({len(updated_vars)} variables updated).")
+        finally:
+            # Rendered files hold secrets - never leave one behind that was not moved into place
+            for future in futures:
+                if future.cancel() or future.exception() is not None:
+                    continue
+                result = future.result()
+                if result and result[0] not in committed:
+                    discard_env_file(result[0])
+
+    if cache_path and written:
+        # The cache holds hashes of secret values, so keep it private to the owner
+        write_env_file(cache_path, [json.dumps(cache, indent=2, sort_keys=True), '\n'])
+        os.chmod(cache_path, 0o600)
+
+    print(f"Wrote {written} of {len(pairs)} file(s), {len(pairs) - written} unchanged.")
+
+def update_env_file_with_local_env(input_file_path, output_file_path):
+    """
+    Reads the input .env file, updates the variables set to GET_FROM_LOCAL_ENV
+    with values from the local environment, and writes the result to the output .env file.
+    """
+    temp_path, updated_vars, missing_vars = render_env_file(input_file_path, output_file_path)
 
     # Print warnings and exit if any required environment variables are missing
     if missing_vars:
@@ -72,23 +279,40 @@ def update_env_file_with_local_env(input_file_path, output_file_path):
             print(f"Warning: {var} set to GET_FROM_LOCAL_ENV, could not find {var}, please set {var} in your local environment and run again.")
         sys.exit(1)
 
-    # Write the updated lines to the output .env file
-    write_env_file(output_file_path, updated_lines)
+    # Move the rendered file into place as the output .env file
+    commit_env_file(temp_path, output_file_path)
 
     # Print the list of updated variables
     if updated_vars:
         print("Updated the following variables:")
         for var in updated_vars:
             print(var)
-    
+
     print(f"Processed {input_file_path} and wrote updates to {output_file_path}.")
 
 if __name__ == "__main__":
     # Parse command-line arguments for input and output file paths
     parser = argparse.ArgumentParser(description='Update .env file with local environment variables.')
-    parser.add_argument('input_file_path', type=str, help='Path to the input .env file')
-    parser.add_argument('output_file_path', type=str, help='Path to the output .env file')
+    parser.add_argument('input_file_path', type=str, nargs='?', help='Path to the input .env file')
+    parser.add_argument('output_file_path', type=str, nargs='?', help='Path to the output .env file')
+    parser.add_argument('--manifest', type=str, help='Path to a manifest of "input output" pairs (batch mode)')
+    parser.add_argument('--jobs', type=int, default=8, help='Files processed concurrently in batch mode')
+    parser.add_argument('--cache', type=str, help=f'Content-hash cache file for batch mode (default: {CACHE_FILE_NAME} next to the manifest)')
+    parser.add_argument('--no-cache', action='store_true', help='Render every file in batch mode, even if unchanged')
     args = parser.parse_args()
 
-    # Update the .env file with local environment variables
-    update_env_file_with_local_env(args.input_file_path, args.output_file_path)
+    if args.manifest:
+        if args.input_file_path or args.output_file_path:
+            parser.error('input/output paths cannot be combined with --manifest')
+        cache_path = None if args.no_cache else (
+            args.cache or os.path.join(os.path.dirname(os.path.abspath(args.manifest)), CACHE_FILE_NAME)
+        )
+        try:
+            update_env_files_from_manifest(args.manifest, args.jobs, cache_path)
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.input_file_path and args.output_file_path:
+        # Update the .env file with local environment variables
+        update_env_file_with_local_env(args.input_file_path, args.output_file_path)
+    else:
+        parser.error('either input_file_path and output_file_path, or --manifest, is required')
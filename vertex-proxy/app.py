@@ -3,35 +3,108 @@
 # This proxy handles authentication and provides an OpenAI-compatible API for LibreChat
 
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, Response
 import httpx
 import json
+import re
 import time
 import random
 import asyncio
 import base64
+import collections
+import functools
+import hashlib
 import uuid
-from google.oauth2 import service_account
-from google.auth.transport.requests import Request as GoogleRequest
-from google.cloud import storage
+import sqlite3
 import os
+from opentelemetry import trace
+from opentelemetry.propagate import extract
+from opentelemetry.trace import SpanKind, Status, StatusCode
+
+# Google auth and storage libraries are imported lazily (they add ~150ms to cold start)
+# google.cloud.storage is only loaded when DeepSeek OCR is enabled and used
+
+# Fast JSON handling - orjson is 5-10x faster than the stdlib json module
+# Falls back to stdlib json when orjson is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = FastAPI()
 
+# Distributed tracing (OpenTelemetry)
+# Spans are no-ops unless an exporter is configured:
+#   "otlp" - export to an OTLP/HTTP collector (configured with OTEL_EXPORTER_OTLP_* variables)
+#   "file" - append one JSON span per line to TRACING_FILE (no network needed)
+TRACING_CONFIG = {
+    "exporter": os.getenv("TRACING_EXPORTER", "none"),
+    "file_path": os.getenv("TRACING_FILE", "/tmp/vertex-proxy-traces.jsonl"),
+    "service_name": os.getenv("OTEL_SERVICE_NAME", "vertex-proxy")
+}
+
+tracer = trace.get_tracer("vertex-proxy")
+_tracer_provider = None
+
+def configure_tracing():
+    """
+    Install the OpenTelemetry SDK tracer provider for the configured exporter
+
+    SDK and exporter modules are only imported when tracing is enabled.
+    """
+    global _tracer_provider
+    exporter_name = TRACING_CONFIG["exporter"]
+    if exporter_name == "none" or _tracer_provider is not None:
+        return
+
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+    if exporter_name == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        exporter = OTLPSpanExporter()
+    elif exporter_name == "file":
+        trace_file = open(TRACING_CONFIG["file_path"], "a")
+        exporter = ConsoleSpanExporter(
+            out=trace_file,
+            formatter=lambda span: span.to_json(indent=None) + "\n"
+        )
+    else:
+        print(f"Warning: Unknown TRACING_EXPORTER '{exporter_name}', tracing disabled")
+        return
+
+    _tracer_provider = TracerProvider(resource=Resource.create({"service.name": TRACING_CONFIG["service_name"]}))
+    _tracer_provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(_tracer_provider)
+
 # Load service account credentials
 SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_APPLICATION_CREDENTIALS", "/app/gcp-sa-key.json")
 
+# Service account JSON, read once and reused for every credentials object
+_service_account_info = None
+
 # Auto-detect project ID from service account key
 def get_project_id():
     """Extract project ID from service account JSON"""
+    global _service_account_info
     try:
         with open(SERVICE_ACCOUNT_FILE, 'r') as f:
-            sa_data = json.load(f)
-            return sa_data.get('project_id')
+            _service_account_info = json.load(f)
+            return _service_account_info.get('project_id')
     except Exception as e:
         print(f"Warning: Could not read project_id from {SERVICE_ACCOUNT_FILE}: {e}")
         return os.getenv("GCP_PROJECT_ID", "vertex--project-durovcik")
 
+def get_service_account_credentials():
+    """Create service account credentials (cloud-platform scope) from the cached key"""
+    from google.oauth2 import service_account
+
+    scopes = ['https://www.googleapis.com/auth/cloud-platform']
+    if _service_account_info is not None:
+        return service_account.Credentials.from_service_account_info(_service_account_info, scopes=scopes)
+    return service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=scopes)
+
 PROJECT_ID = get_project_id()
 
 # Print on startup
@@ -40,13 +113,53 @@ async def startup_event():
     print(f"=== Vertex AI Proxy Started ===")
     print(f"Using GCP Project: {PROJECT_ID}")
     print(f"Service Account: {SERVICE_ACCOUNT_FILE}")
+    print(f"Tracing exporter: {TRACING_CONFIG['exporter']}")
+    print(f"Usage ledger: {USAGE_CONFIG['db_path'] if USAGE_CONFIG['enabled'] else 'disabled'}")
     print(f"===============================")
+    if CAPTURE_CONFIG["enabled"]:
+        print(f"Traffic capture: {CAPTURE_CONFIG['file_path']}")
+    configure_tracing()
+    if USAGE_CONFIG["enabled"] or CAPTURE_CONFIG["enabled"]:
+        app.state.flush_task = asyncio.create_task(background_flush_loop())
+
+    # Warm up in the background: the server accepts connections (liveness)
+    # immediately, and /ready reports when the first request won't pay init costs
+    reset_http_client()
+    app.state.warmup_task = asyncio.create_task(warm_up())
+    if HEALTH_CONFIG["probe_mode"] == "synthetic":
+        app.state.health_probe_task = asyncio.create_task(health_probe_loop())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Flush buffered usage/capture records and spans before exit
+    if USAGE_CONFIG["enabled"] or CAPTURE_CONFIG["enabled"]:
+        app.state.flush_task.cancel()
+        await flush_usage()
+        await flush_capture()
+    app.state.warmup_task.cancel()
+    if HEALTH_CONFIG["probe_mode"] == "synthetic":
+        app.state.health_probe_task.cancel()
+    if _http_client is not None:
+        await _http_client.aclose()
+    if _tracer_provider is not None:
+        _tracer_provider.shutdown()
 
 # GCS bucket for temporary OCR image storage
 # DeepSeek OCR only accepts gs:// URLs, not base64
 GCS_BUCKET_NAME = os.getenv("GCS_OCR_BUCKET", f"vertex-ocr-temp-{PROJECT_ID}")
 GCS_TEMP_PREFIX = "deepseek-ocr-temp/"
 
+# Multi-page OCR fan-out
+# Requests with several images are split into one upstream request per page,
+# dispatched concurrently and merged back in page order
+OCR_FANOUT_CONFIG = {
+    "enabled": os.getenv("OCR_PAGE_FANOUT", "true").lower() == "true",
+    "min_pages": 2,                                             # Fewer images are sent as a single request
+    "max_concurrency": int(os.getenv("OCR_MAX_CONCURRENCY", "8")),  # Pages in flight per request
+    "page_retries": 3,                                          # Retries per page (uses RETRY_CONFIG backoff)
+    "page_separator": "\n\n"                                  # Joins page texts in the merged response
+}
+
 # Initialize GCS client (lazy loaded)
 _gcs_client = None
 
@@ -54,11 +167,9 @@ def get_gcs_client():
     """Get or create GCS storage client"""
     global _gcs_client
     if _gcs_client is None:
-        credentials = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE,
-            scopes=['https://www.googleapis.com/auth/cloud-platform']
-        )
-        _gcs_client = storage.Client(credentials=credentials, project=PROJECT_ID)
+        from google.cloud import storage
+
+        _gcs_client = storage.Client(credentials=get_service_account_credentials(), project=PROJECT_ID)
     return _gcs_client
 
 # Token caching - reduces auth latency by 50-100ms per request
@@ -172,6 +283,58 @@ MODEL_ENDPOINTS = {
     }
 }
 
+# Local overrides for offline testing and traffic replay (see replay.py)
+# UPSTREAM_URL_OVERRIDE sends every model to a single URL (e.g. a mock upstream)
+# STATIC_ACCESS_TOKEN is sent instead of generating an OAuth2 token
+UPSTREAM_URL_OVERRIDE = os.getenv("UPSTREAM_URL_OVERRIDE")
+STATIC_ACCESS_TOKEN = os.getenv("STATIC_ACCESS_TOKEN")
+
+# DeepSeek OCR needs GCS; disabling it also skips loading google.cloud.storage
+OCR_ENABLED = os.getenv("OCR_ENABLED", "true").lower() == "true"
+if not OCR_ENABLED:
+    MODEL_ENDPOINTS.pop("deepseek-ocr", None)
+
+if UPSTREAM_URL_OVERRIDE:
+    for model_endpoints in MODEL_ENDPOINTS.values():
+        for model_endpoint in (model_endpoints if isinstance(model_endpoints, list) else [model_endpoints]):
+            model_endpoint["url"] = UPSTREAM_URL_OVERRIDE
+
+# Per-model context limits used for pre-flight token budget checks
+# Oversized prompts are rejected locally with a 400 instead of after a full
+# Vertex AI round-trip (and retries/failover across every pooled endpoint)
+# Models without an entry (e.g. deepseek-ocr) are not checked
+MODEL_LIMITS = {
+    "deepseek-r1": {"family": "deepseek", "context_window": 163840, "max_output_tokens": 32768},
+    "deepseek-v3": {"family": "deepseek", "context_window": 163840, "max_output_tokens": 32768},
+    "minimax-m2": {"family": "minimax", "context_window": 196608, "max_output_tokens": 32768},
+    "qwen3-235b": {"family": "qwen", "context_window": 262144, "max_output_tokens": 32768},
+    "llama-3.3-70b": {"family": "llama", "context_window": 128000, "max_output_tokens": 8192},
+    "qwen3-thinking": {"family": "qwen", "context_window": 262144, "max_output_tokens": 32768},
+    "llama-4-maverick": {"family": "llama", "context_window": 524288, "max_output_tokens": 8192},
+    "llama-4-scout": {"family": "llama", "context_window": 1310720, "max_output_tokens": 8192}
+}
+
+# Pre-flight context check configuration
+CONTEXT_CONFIG = {
+    "enabled": os.getenv("CONTEXT_CHECK_ENABLED", "true").lower() == "true",
+    "trim_policy": os.getenv("CONTEXT_TRIM_POLICY", "none"),  # "none" (reject) or "drop_oldest"
+    "safety_margin": 0.05,     # Estimation error allowance: rejection allows 5% over the window, trimming targets 5% under
+    "offload_bytes": 262144,   # Larger bodies are estimated in a worker thread, off the event loop
+    "sample_chars": 6144,      # Texts longer than this are sampled (bounds estimation cost)
+    "message_overhead": 4,     # Tokens per message for role/formatting markers
+    "image_tokens": 1024       # Flat estimate per image content part
+}
+
+# Approximate tokenizer parameters per model family
+# chars_per_word_token: long words are split into roughly this many chars per token
+# cjk_tokens_per_char: CJK characters are mostly single tokens (fewer with large vocabularies)
+TOKENIZER_FAMILIES = {
+    "deepseek": {"chars_per_word_token": 4.2, "cjk_tokens_per_char": 0.7},
+    "qwen": {"chars_per_word_token": 4.4, "cjk_tokens_per_char": 0.7},
+    "llama": {"chars_per_word_token": 4.0, "cjk_tokens_per_char": 1.0},
+    "minimax": {"chars_per_word_token": 4.2, "cjk_tokens_per_char": 0.8}
+}
+
 def get_access_token():
     """
     Generate OAuth2 access token from service account with caching
@@ -180,6 +343,9 @@ def get_access_token():
     Tokens are cached for 55 minutes (GCP tokens expire after 1 hour)
     This reduces auth latency by 50-100ms per request
     """
+    if STATIC_ACCESS_TOKEN:
+        return STATIC_ACCESS_TOKEN
+
     try:
         # Check if we have a valid cached token
         current_time = time.time()
@@ -189,10 +355,9 @@ def get_access_token():
 
         # Generate new token
         print("Generating new OAuth2 token...")
-        credentials = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE,
-            scopes=['https://www.googleapis.com/auth/cloud-platform']
-        )
+        from google.auth.transport.requests import Request as GoogleRequest
+
+        credentials = get_service_account_credentials()
         credentials.refresh(GoogleRequest())
 
         # Cache the token for 55 minutes (3300 seconds)
@@ -205,6 +370,271 @@ def get_access_token():
         print(f"Error getting access token: {e}")
         raise
 
+# Shared HTTP client - connections to each Vertex AI region are pooled and reused
+# across requests (a new client per request paid a TCP + TLS handshake every time)
+# Streams hold a connection for their whole duration, so the pool is uncapped by default
+# (like the original per-request clients); with a cap, requests beyond it fail after pool_timeout
+HTTP_CLIENT_CONFIG = {
+    "timeout": 600.0,          # Long generations can take minutes
+    "max_connections": int(os.getenv("HTTP_MAX_CONNECTIONS", "0")) or None,  # 0 = no cap
+    "pool_timeout": float(os.getenv("HTTP_POOL_TIMEOUT", "10")),  # Wait for a free connection (only with a cap)
+    "keepalive_expiry": 120.0  # Keep warmed connections open between requests
+}
+
+_http_client = None
+
+def get_http_client():
+    """Get or create the shared httpx client"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(HTTP_CLIENT_CONFIG["timeout"], pool=HTTP_CLIENT_CONFIG["pool_timeout"]),
+            limits=httpx.Limits(
+                max_connections=HTTP_CLIENT_CONFIG["max_connections"],
+                keepalive_expiry=HTTP_CLIENT_CONFIG["keepalive_expiry"]
+            )
+        )
+    return _http_client
+
+def reset_http_client():
+    """Drop the shared client so it is recreated on the current event loop"""
+    global _http_client
+    _http_client = None
+
+# Warm-up state reported by /ready
+warmup_state = {
+    "ready": False,
+    "started_at": None,
+    "duration_ms": None,
+    "steps": {},
+    "errors": {}  # Last error per step (bounded even while the token step keeps retrying)
+}
+
+def endpoint_origins():
+    """Unique scheme://host origins of all configured endpoints"""
+    origins = []
+    for model_endpoints in MODEL_ENDPOINTS.values():
+        for model_endpoint in (model_endpoints if isinstance(model_endpoints, list) else [model_endpoints]):
+            url = httpx.URL(model_endpoint["url"])
+            origin = f"{url.scheme}://{url.netloc.decode('ascii')}"
+            if origin not in origins:
+                origins.append(origin)
+    return origins
+
+async def warm_up():
+    """
+    Pay initialization costs before the first request arrives
+
+    1. Fetch the OAuth2 token (retried until it succeeds - required for readiness)
+    2. Pre-open pooled connections to every region in MODEL_ENDPOINTS
+    3. Create the GCS client if DeepSeek OCR is enabled
+
+    Connection and GCS failures are reported but don't block readiness.
+    """
+    warmup_state["started_at"] = time.time()
+    started = time.perf_counter()
+
+    while True:
+        step_started = time.perf_counter()
+        try:
+            await asyncio.to_thread(get_access_token)
+            warmup_state["steps"]["token_ms"] = round((time.perf_counter() - step_started) * 1000, 1)
+            break
+        except Exception as e:
+            warmup_state["errors"]["token"] = str(e)
+            await asyncio.sleep(10)
+
+    async def open_connection(origin):
+        connection_started = time.perf_counter()
+        try:
+            # Any response (even 404) leaves a warm TLS connection in the pool
+            await get_http_client().get(origin + "/", timeout=10.0)
+            return origin, round((time.perf_counter() - connection_started) * 1000, 1)
+        except Exception as e:
+            warmup_state["errors"][f"connect {origin}"] = str(e)
+            return origin, None
+
+    warmup_state["steps"]["connections_ms"] = dict(
+        await asyncio.gather(*[open_connection(origin) for origin in endpoint_origins()])
+    )
+
+    if "deepseek-ocr" in MODEL_ENDPOINTS:
+        step_started = time.perf_counter()
+        try:
+            await asyncio.to_thread(get_gcs_client)
+            warmup_state["steps"]["gcs_client_ms"] = round((time.perf_counter() - step_started) * 1000, 1)
+        except Exception as e:
+            warmup_state["errors"]["gcs"] = str(e)
+
+    warmup_state["duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    warmup_state["ready"] = True
+    print(f"Warm-up complete in {warmup_state['duration_ms']}ms")
+
+# Endpoint health tracking
+# Passive signals come from every real upstream attempt; synthetic probes (max_tokens=1)
+# only run for endpoints without recent traffic, within a global hourly budget
+HEALTH_CONFIG = {
+    "probe_mode": os.getenv("HEALTH_PROBE_MODE", "synthetic"),  # "synthetic" or "off" (passive only)
+    "probe_interval": 300,        # Probe an endpoint only if it has had no traffic for this many seconds
+    "probe_budget_per_hour": int(os.getenv("HEALTH_PROBE_BUDGET_PER_HOUR", "60")),
+    "probe_timeout": 15.0,
+    "check_interval": 15,         # Seconds between probe scheduler ticks
+    "window_seconds": 600,        # Availability is computed over this window
+    "sample_size": 200,           # Latency/outcome samples kept per endpoint
+    "degraded_availability": 0.9, # Below this an endpoint is degraded
+    "down_consecutive_failures": 5
+}
+
+# Selection weight multiplier per endpoint state
+HEALTH_WEIGHT_FACTORS = {"healthy": 1.0, "unknown": 1.0, "degraded": 0.25, "down": 0.0}
+
+endpoint_health = {}
+probe_history = collections.deque()  # Timestamps of synthetic probes in the last hour
+
+def endpoint_region(endpoint):
+    """Region of an endpoint: explicit "region" key, else the location in its URL"""
+    if endpoint.get("region"):
+        return endpoint["region"]
+    match = re.search(r"/locations/([^/]+)/", endpoint["url"])
+    return match.group(1) if match else "unknown"
+
+def get_endpoint_health(model_id, endpoint, create=True):
+    """Get (or create) the health record of an endpoint"""
+    key = f"{model_id}@{endpoint_region(endpoint)}"
+    health = endpoint_health.get(key)
+    if health is None and create:
+        health = endpoint_health[key] = {
+            "latencies_ms": collections.deque(maxlen=HEALTH_CONFIG["sample_size"]),
+            "outcomes": collections.deque(maxlen=HEALTH_CONFIG["sample_size"]),
+            "consecutive_failures": 0,
+            "last_success": None,
+            "last_failure": None,
+            "last_activity": None,
+            "probes": 0
+        }
+    return health
+
+def record_endpoint_outcome(model_id, endpoint, ok, latency_ms=None, probe=False):
+    """
+    Record the outcome of an upstream attempt (or synthetic probe) for an endpoint
+
+    ok should be False for 5xx, 429 and connection errors - client errors (4xx)
+    say nothing about the endpoint's health.
+    """
+    health = get_endpoint_health(model_id, endpoint)
+    now = time.time()
+    health["outcomes"].append((now, ok))
+    health["last_activity"] = now
+    if latency_ms is not None and ok:
+        health["latencies_ms"].append(latency_ms)
+    if ok:
+        health["consecutive_failures"] = 0
+        health["last_success"] = now
+    else:
+        health["consecutive_failures"] += 1
+        health["last_failure"] = now
+    if probe:
+        health["probes"] += 1
+
+def endpoint_state(health):
+    """
+    Classify an endpoint as healthy, degraded, down or unknown
+
+    Returns: (state, availability over the window or None)
+    """
+    if health is None:
+        return "unknown", None
+
+    cutoff = time.time() - HEALTH_CONFIG["window_seconds"]
+    recent = [ok for ts, ok in health["outcomes"] if ts >= cutoff]
+    if not recent:
+        return "unknown", None
+
+    availability = sum(recent) / len(recent)
+    if health["consecutive_failures"] >= HEALTH_CONFIG["down_consecutive_failures"]:
+        return "down", availability
+    if availability < HEALTH_CONFIG["degraded_availability"]:
+        return "degraded", availability
+    return "healthy", availability
+
+def endpoint_health_report(model_id, endpoint):
+    """Health summary of one endpoint (state, availability, latency percentiles)"""
+    health = get_endpoint_health(model_id, endpoint, create=False)
+    state, availability = endpoint_state(health)
+    latencies = sorted(health["latencies_ms"]) if health else []
+
+    def latency_percentile(fraction):
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))], 1)
+
+    return {
+        "region": endpoint_region(endpoint),
+        "state": state,
+        "availability": round(availability, 3) if availability is not None else None,
+        "latency_p50_ms": latency_percentile(0.5),
+        "latency_p95_ms": latency_percentile(0.95),
+        "latency_p99_ms": latency_percentile(0.99),
+        "consecutive_failures": health["consecutive_failures"] if health else 0,
+        "last_success": health["last_success"] if health else None,
+        "probes": health["probes"] if health else 0
+    }
+
+async def probe_endpoint(model_id, endpoint):
+    """Send a minimal synthetic request (1 output token) to an endpoint"""
+    payload = {
+        "model": endpoint["model"],
+        "messages": [{"role": "user", "content": "ping"}],
+        "max_tokens": 1,
+        "stream": False
+    }
+    started = time.perf_counter()
+    try:
+        access_token = await asyncio.to_thread(get_access_token)
+        response = await get_http_client().post(
+            endpoint["url"],
+            content=json_dumps(payload),
+            headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+            timeout=HEALTH_CONFIG["probe_timeout"]
+        )
+        # The probe payload is known-good, so any non-200 (including 401/403/404 from expired
+        # credentials or a model not enabled in the region) means the endpoint cannot serve
+        ok = response.status_code == 200
+        if not ok:
+            print(f"Health probe {model_id} ({endpoint_region(endpoint)}): HTTP {response.status_code}")
+    except Exception as e:
+        print(f"Health probe {model_id} ({endpoint_region(endpoint)}) failed: {e}")
+        ok = False
+    record_endpoint_outcome(model_id, endpoint, ok, (time.perf_counter() - started) * 1000, probe=True)
+
+async def health_probe_loop():
+    """
+    Background task: probe idle endpoints within the hourly probe budget
+
+    Endpoints with real traffic in the last probe_interval seconds are not probed
+    (passive signals are enough), so busy proxies spend no quota on probes.
+    """
+    while True:
+        await asyncio.sleep(HEALTH_CONFIG["check_interval"])
+        if not warmup_state["ready"]:
+            continue
+
+        now = time.time()
+        while probe_history and probe_history[0] < now - 3600:
+            probe_history.popleft()
+
+        for model_id, model_endpoints in MODEL_ENDPOINTS.items():
+            if model_id == "deepseek-ocr":
+                continue  # OCR only accepts images - there is no cheap synthetic request
+            for endpoint in (model_endpoints if isinstance(model_endpoints, list) else [model_endpoints]):
+                health = get_endpoint_health(model_id, endpoint, create=False)
+                if health and now - health["last_activity"] < HEALTH_CONFIG["probe_interval"]:
+                    continue
+                if len(probe_history) >= HEALTH_CONFIG["probe_budget_per_hour"]:
+                    break
+                probe_history.append(now)
+                await probe_endpoint(model_id, endpoint)
+
 def select_endpoint(model_id):
     """
     Select an endpoint from the pool using weighted random selection
@@ -222,15 +652,24 @@ def select_endpoint(model_id):
         return endpoints, False
 
     # Multiple endpoints - use weighted random selection
+    # Weights are scaled by endpoint health (degraded endpoints get less traffic, down ones none)
     if isinstance(endpoints, list):
-        total_weight = sum(ep.get("weight", 1) for ep in endpoints)
+        weights = [
+            ep.get("weight", 1) * HEALTH_WEIGHT_FACTORS[endpoint_state(get_endpoint_health(model_id, ep, create=False))[0]]
+            for ep in endpoints
+        ]
+        if not any(weights):
+            # Every endpoint is down - fall back to configured weights rather than fail outright
+            weights = [ep.get("weight", 1) for ep in endpoints]
+
+        total_weight = sum(weights)
         random_value = random.uniform(0, total_weight)
 
         current_weight = 0
-        for endpoint in endpoints:
-            current_weight += endpoint.get("weight", 1)
-            if random_value <= current_weight:
-                region = endpoint.get("region", "unknown")
+        for endpoint, weight in zip(endpoints, weights):
+            current_weight += weight
+            if weight and random_value <= current_weight:
+                region = endpoint_region(endpoint)
                 print(f"Selected endpoint in region: {region}")
                 return endpoint, True
 
@@ -239,6 +678,524 @@ def select_endpoint(model_id):
 
     return None, False
 
+def json_loads(data):
+    """
+    Parse JSON (bytes or str), using orjson when available
+
+    orjson is stricter than the stdlib parser: it rejects lone surrogate escapes
+    (e.g. "\\ud83d", emitted by JSON.stringify for a string cut mid-emoji) and NaN.
+    Those bodies are valid for the stdlib parser, so they fall back to it.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+def json_dumps(obj):
+    """
+    Serialize an object to compact UTF-8 JSON bytes, using orjson when available
+
+    Strings with lone surrogates can't be encoded as UTF-8, so they are written
+    as \\u escapes by the stdlib encoder instead.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except orjson.JSONEncodeError:
+            pass
+    try:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    except UnicodeEncodeError:
+        return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+def patch_model_field(raw_body, body, original_model, new_model):
+    """
+    Rewrite the top-level "model" value of a raw JSON request body
+
+    Long multi-turn conversations can be several MB of JSON, and re-encoding
+    the whole body just to swap the model name is wasted CPU. Instead the
+    model value is patched in place on the raw bytes.
+
+    The patch is only applied when `"model": "<original_model>"` occurs exactly
+    once in the body (so it can only be the top-level field). Otherwise the
+    parsed body is re-serialized with the new model as a safe fallback.
+
+    Args:
+        raw_body: Raw request body bytes as received from the client
+        body: Parsed request body dict (used for the fallback path)
+        original_model: Model name sent by the client (e.g. "deepseek-v3")
+        new_model: Vertex AI model ID to substitute
+
+    Returns:
+        bytes: Request body to send upstream
+    """
+    pattern = re.compile(rb'"model"\s*:\s*' + re.escape(json.dumps(original_model).encode("utf-8")))
+    replacement = b'"model":' + json.dumps(new_model).encode("utf-8")
+
+    patched, count = pattern.subn(lambda _: replacement, raw_body)
+    if count == 1:
+        return patched
+
+    return json_dumps({**body, "model": new_model})
+
+# Response headers that must not be forwarded verbatim
+# httpx transparently decodes compressed bodies (so encoding/length no longer apply),
+# hop-by-hop headers are connection specific, and uvicorn adds its own date/server
+EXCLUDED_RESPONSE_HEADERS = {
+    "content-encoding",
+    "content-length",
+    "transfer-encoding",
+    "connection",
+    "keep-alive",
+    "date",
+    "server"
+}
+
+def passthrough_headers(response):
+    """Return upstream response headers that are safe to forward to the client"""
+    return {
+        key: value
+        for key, value in response.headers.items()
+        if key.lower() not in EXCLUDED_RESPONSE_HEADERS
+    }
+
+# Pre-tokenization patterns for the approximate tokenizers
+CJK_CHAR_PATTERN = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]")
+WORD_PATTERN = re.compile(r"[^\W\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+")
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s]")
+
+@functools.lru_cache(maxsize=None)
+def get_tokenizer(family):
+    """
+    Get the approximate token counter for a model family (cached per family)
+
+    The counter pre-tokenizes text into words, punctuation and CJK characters
+    and applies per-family ratios. It is within ~10-15% of the real BPE
+    tokenizers for typical chat text, without shipping any vocabulary files.
+
+    Texts longer than CONTEXT_CONFIG["sample_chars"] are estimated from three
+    windows (start, middle, end) and scaled, so cost is bounded per message.
+
+    Returns:
+        Function taking a string and returning an estimated token count (float)
+    """
+    params = TOKENIZER_FAMILIES.get(family, TOKENIZER_FAMILIES["llama"])
+    chars_per_word_token = params["chars_per_word_token"]
+    cjk_tokens_per_char = params["cjk_tokens_per_char"]
+
+    def count_exact(text):
+        words = WORD_PATTERN.findall(text)
+        word_tokens = sum(max(1.0, len(word) / chars_per_word_token) for word in words)
+        cjk_tokens = len(CJK_CHAR_PATTERN.findall(text)) * cjk_tokens_per_char
+        punctuation_tokens = len(PUNCTUATION_PATTERN.findall(text))
+        return word_tokens + cjk_tokens + punctuation_tokens
+
+    def count_tokens(text):
+        sample_chars = CONTEXT_CONFIG["sample_chars"]
+        if len(text) <= sample_chars:
+            return count_exact(text)
+
+        window = sample_chars // 3
+        middle = len(text) // 2
+        sample = text[:window] + " " + text[middle:middle + window] + " " + text[-window:]
+        return count_exact(sample) * len(text) / len(sample)
+
+    return count_tokens
+
+def estimate_message_tokens(message, count_tokens):
+    """Estimate tokens for a single chat message (content, tool calls and overhead)"""
+    tokens = CONTEXT_CONFIG["message_overhead"]
+    content = message.get("content")
+
+    if isinstance(content, str):
+        tokens += count_tokens(content)
+    elif isinstance(content, list):
+        for part in content:
+            if not isinstance(part, dict):
+                continue
+            if part.get("type") == "text":
+                tokens += count_tokens(part.get("text") or "")
+            elif part.get("type") == "image_url":
+                tokens += CONTEXT_CONFIG["image_tokens"]
+
+    if message.get("tool_calls"):
+        tokens += count_tokens(json_dumps(message["tool_calls"]).decode("utf-8"))
+
+    return tokens
+
+def enforce_context_budget(model_id, body, body_bytes=None):
+    """
+    Check a request against the model's context window and output limit
+
+    Estimates prompt tokens locally and compares prompt + max_tokens with the
+    context window. The estimate is approximate, so requests are only rejected
+    when they exceed the window by more than the safety margin. With the
+    "drop_oldest" trim policy, the oldest non-system messages are removed until
+    the request fits the window minus the safety margin.
+
+    Byte-level BPE tokenizers produce at most one token per byte, so a body
+    that fits the budget in bytes is not run through the tokenizer: its
+    estimate is the body size divided by the family's chars per token
+    (rougher, and slightly high because it includes JSON syntax).
+
+    Args:
+        model_id: Proxy model name (key of MODEL_LIMITS)
+        body: Parsed request body dict (messages may be trimmed in place)
+        body_bytes: Size of the raw request body, enables the byte-count short-circuit
+
+    Returns:
+        tuple: (estimated prompt tokens - byte-based for bodies that clearly fit -
+        or None if unchecked, number of messages trimmed)
+
+    Raises:
+        ValueError: If the request cannot fit the model's limits
+    """
+    limits = MODEL_LIMITS.get(model_id)
+    messages = body.get("messages")
+    if not CONTEXT_CONFIG["enabled"] or not limits or not isinstance(messages, list):
+        return None, 0
+
+    count_tokens = get_tokenizer(limits["family"])
+    context_window = limits["context_window"]
+
+    requested_output = body.get("max_tokens") or body.get("max_completion_tokens") or 0
+    if not isinstance(requested_output, int) or isinstance(requested_output, bool):
+        requested_output = 0
+    if requested_output > limits["max_output_tokens"]:
+        raise ValueError(
+            f"max_tokens ({requested_output}) exceeds the maximum output of "
+            f"{limits['max_output_tokens']} tokens for model {model_id}"
+        )
+
+    reject_budget = int(context_window * (1 + CONTEXT_CONFIG["safety_margin"]))
+    trim_budget = int(context_window * (1 - CONTEXT_CONFIG["safety_margin"]))
+
+    # A body that fits in bytes can't be rejected, so it only gets a cheap byte-based
+    # estimate for usage accounting (body size / chars per token - includes JSON overhead)
+    # Images are estimated at a flat token count that their URL bytes don't bound
+    if body_bytes is not None and body_bytes + requested_output <= trim_budget and not any(
+        isinstance(message, dict) and isinstance(message.get("content"), list)
+        and any(isinstance(part, dict) and part.get("type") == "image_url" for part in message["content"])
+        for message in messages
+    ):
+        return int(body_bytes / TOKENIZER_FAMILIES[limits["family"]]["chars_per_word_token"]), 0
+
+    fixed_tokens = 3  # Every reply is primed with assistant markers
+    if body.get("tools"):
+        fixed_tokens += count_tokens(json_dumps(body["tools"]).decode("utf-8"))
+
+    # Without trimming, stop estimating (newest messages first) once the request is sure to be rejected
+    message_tokens = [0] * len(messages)
+    prompt_tokens = fixed_tokens
+    for index in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[index], dict):
+            message_tokens[index] = estimate_message_tokens(messages[index], count_tokens)
+            prompt_tokens += message_tokens[index]
+        if prompt_tokens + requested_output > reject_budget and CONTEXT_CONFIG["trim_policy"] != "drop_oldest":
+            output_note = f" plus max_tokens {requested_output}" if requested_output else ""
+            raise ValueError(
+                f"Request is more than ~{int(prompt_tokens)} prompt tokens (estimated){output_note}, "
+                f"which exceeds the {context_window}-token context window of model {model_id}"
+            )
+    trimmed = 0
+
+    if prompt_tokens + requested_output > trim_budget and CONTEXT_CONFIG["trim_policy"] == "drop_oldest":
+        # Drop the oldest non-system messages, always keeping the latest message
+        index = 0
+        while prompt_tokens + requested_output > trim_budget and index < len(messages) - 1:
+            message = messages[index]
+            if isinstance(message, dict) and message.get("role") == "system":
+                index += 1
+                continue
+            prompt_tokens -= message_tokens.pop(index)
+            messages.pop(index)
+            trimmed += 1
+
+        # Don't leave tool results whose assistant tool call was trimmed
+        while (
+            trimmed
+            and index < len(messages) - 1
+            and isinstance(messages[index], dict)
+            and messages[index].get("role") == "tool"
+        ):
+            prompt_tokens -= message_tokens.pop(index)
+            messages.pop(index)
+            trimmed += 1
+
+        if trimmed:
+            print(f"Context budget: trimmed {trimmed} oldest message(s) for {model_id} (~{int(prompt_tokens)} prompt tokens)")
+
+    prompt_tokens = int(prompt_tokens)
+    if prompt_tokens + requested_output > reject_budget:
+        if requested_output:
+            raise ValueError(
+                f"Request is ~{prompt_tokens} prompt tokens (estimated) plus max_tokens {requested_output}, "
+                f"which exceeds the {context_window}-token context window of model {model_id}"
+            )
+        raise ValueError(
+            f"Request is ~{prompt_tokens} prompt tokens (estimated), "
+            f"which exceeds the {context_window}-token context window of model {model_id}"
+        )
+
+    return prompt_tokens, trimmed
+
+# Usage accounting ledger
+# Every request appends one record to an in-memory buffer (no I/O on the hot path);
+# a background task flushes the buffer to SQLite in batches
+USAGE_CONFIG = {
+    "enabled": os.getenv("USAGE_ENABLED", "true").lower() == "true",
+    "db_path": os.getenv("USAGE_DB_PATH", "/tmp/vertex-proxy-usage.sqlite3"),
+    "user_header": os.getenv("USAGE_USER_HEADER", "x-user-id"),
+    "flush_interval": 5.0,     # Seconds between background flushes
+    "max_buffer": 50000,       # Drop oldest records beyond this if the database is unavailable
+    "tail_bytes": 8192         # Bytes of a streamed response kept to find the final usage block
+}
+
+USAGE_COLUMNS = (
+    "ts", "model", "upstream_model", "region", "user", "stream", "status",
+    "prompt_tokens", "completion_tokens", "reasoning_tokens", "total_tokens",
+    "estimated_prompt_tokens", "latency_ms", "attempts"
+)
+
+# Dimensions accepted by /usage?group_by=...
+USAGE_GROUP_COLUMNS = {
+    "model": "model",
+    "region": "region",
+    "user": "user",
+    "status": "status",
+    "hour": "strftime('%Y-%m-%dT%H:00', ts, 'unixepoch')",
+    "day": "strftime('%Y-%m-%d', ts, 'unixepoch')"
+}
+
+usage_buffer = []
+
+def extract_usage(raw):
+    """
+    Extract the last "usage" object from a raw response body or stream tail
+
+    Only the usage object itself is parsed, so large responses are not decoded.
+
+    Returns:
+        dict or None if no usage block is present
+    """
+    index = raw.rfind(b'"usage"')
+    while index != -1:
+        start = raw.find(b"{", index, index + 64)
+        if start != -1 and raw[index + 7:start].strip(b" \t\r\n:") == b"":
+            depth = 0
+            for position in range(start, len(raw)):
+                char = raw[position]
+                if char == 0x7B:  # {
+                    depth += 1
+                elif char == 0x7D:  # }
+                    depth -= 1
+                    if depth == 0:
+                        try:
+                            usage = json_loads(raw[start:position + 1])
+                        except ValueError:
+                            break
+                        return usage if isinstance(usage, dict) else None
+        # "usage": null (intermediate stream chunks) - look further back
+        index = raw.rfind(b'"usage"', 0, index)
+    return None
+
+def record_usage(request, status_code, usage=None):
+    """
+    Append a usage record for a finished request to the in-memory buffer
+
+    Request details (model, region, attempts, timings) are read from
+    request.state, populated by chat_completions/proxy_chat_completion.
+    """
+    if not USAGE_CONFIG["enabled"]:
+        return
+
+    state = request.state
+    usage = usage or {}
+    details = usage.get("completion_tokens_details") or {}
+    reasoning_tokens = details.get("reasoning_tokens") or usage.get("reasoning_tokens") or 0
+    started_at = getattr(state, "started_at", None)
+
+    usage_buffer.append((
+        time.time(),
+        getattr(state, "model_id", None),
+        getattr(state, "upstream_model", None),
+        getattr(state, "vertex_region", None),
+        request.headers.get(USAGE_CONFIG["user_header"]),
+        int(bool(getattr(state, "stream", False))),
+        status_code,
+        usage.get("prompt_tokens") or 0,
+        usage.get("completion_tokens") or 0,
+        reasoning_tokens,
+        usage.get("total_tokens") or 0,
+        getattr(state, "estimated_prompt_tokens", None),
+        round((time.perf_counter() - started_at) * 1000, 1) if started_at else None,
+        getattr(state, "attempts", 0)
+    ))
+
+    overflow = len(usage_buffer) - USAGE_CONFIG["max_buffer"]
+    if overflow > 0:
+        del usage_buffer[:overflow]
+        print(f"Warning: Usage buffer full, dropped {overflow} oldest record(s)")
+
+def open_usage_db():
+    """Open the usage SQLite database, creating the schema if needed"""
+    connection = sqlite3.connect(USAGE_CONFIG["db_path"])
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS usage ("
+        "ts REAL, model TEXT, upstream_model TEXT, region TEXT, user TEXT, "
+        "stream INTEGER, status INTEGER, prompt_tokens INTEGER, completion_tokens INTEGER, "
+        "reasoning_tokens INTEGER, total_tokens INTEGER, estimated_prompt_tokens INTEGER, "
+        "latency_ms REAL, attempts INTEGER)"
+    )
+    connection.execute("CREATE INDEX IF NOT EXISTS usage_ts ON usage (ts)")
+    return connection
+
+def write_usage_batch(batch):
+    """Write a batch of usage records in a single transaction (runs in a worker thread)"""
+    connection = open_usage_db()
+    try:
+        with connection:
+            connection.executemany(
+                f"INSERT INTO usage ({', '.join(USAGE_COLUMNS)}) VALUES ({', '.join('?' * len(USAGE_COLUMNS))})",
+                batch
+            )
+    finally:
+        connection.close()
+
+async def flush_usage():
+    """Flush buffered usage records to SQLite without blocking the event loop"""
+    if not usage_buffer:
+        return
+
+    batch = usage_buffer[:]
+    del usage_buffer[:len(batch)]
+    try:
+        await asyncio.to_thread(write_usage_batch, batch)
+    except Exception as e:
+        print(f"Warning: Could not write {len(batch)} usage record(s): {e}")
+        usage_buffer[:0] = batch
+
+async def background_flush_loop():
+    """Background task: flush the usage and capture buffers every flush_interval seconds"""
+    while True:
+        await asyncio.sleep(USAGE_CONFIG["flush_interval"])
+        await flush_usage()
+        await flush_capture()
+
+def parse_time_window(window):
+    """Convert a window like "30m", "24h" or "7d" to seconds"""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if not window or window[-1] not in units:
+        raise ValueError(f"Invalid window '{window}' (expected e.g. 30m, 24h, 7d)")
+    return float(window[:-1]) * units[window[-1]]
+
+def query_usage(group_by, since, filters):
+    """
+    Roll up usage records since a timestamp, grouped by the given dimensions
+
+    Args:
+        group_by: List of keys of USAGE_GROUP_COLUMNS
+        since: Unix timestamp lower bound
+        filters: Dict of column -> exact value (model, region, user)
+
+    Returns:
+        list of dicts, one per group
+    """
+    select_columns = [f"{USAGE_GROUP_COLUMNS[key]} AS {key}" for key in group_by]
+    conditions = ["ts >= ?"]
+    params = [since]
+    for column, value in filters.items():
+        conditions.append(f"{column} = ?")
+        params.append(value)
+
+    sql = (
+        f"SELECT {', '.join(select_columns + [''])}"
+        "COUNT(*) AS requests, "
+        "SUM(CASE WHEN status >= 400 THEN 1 ELSE 0 END) AS errors, "
+        "SUM(prompt_tokens) AS prompt_tokens, "
+        "SUM(completion_tokens) AS completion_tokens, "
+        "SUM(reasoning_tokens) AS reasoning_tokens, "
+        "SUM(total_tokens) AS total_tokens, "
+        "ROUND(AVG(latency_ms), 1) AS avg_latency_ms, "
+        "ROUND(MAX(latency_ms), 1) AS max_latency_ms "
+        f"FROM usage WHERE {' AND '.join(conditions)}"
+    )
+    if group_by:
+        sql += f" GROUP BY {', '.join(group_by)} ORDER BY total_tokens DESC"
+
+    connection = open_usage_db()
+    try:
+        connection.row_factory = sqlite3.Row
+        return [dict(row) for row in connection.execute(sql, params)]
+    finally:
+        connection.close()
+
+# Traffic capture for offline performance regression testing (see replay.py)
+# Records request shape, upstream status sequence and stream timing - never message content
+CAPTURE_CONFIG = {
+    "enabled": os.getenv("CAPTURE_ENABLED", "false").lower() == "true",
+    "file_path": os.getenv("CAPTURE_FILE", "/tmp/vertex-proxy-capture.jsonl"),
+    "redact_user": os.getenv("CAPTURE_REDACT_USER", "true").lower() == "true",
+    "max_chunk_gaps": 2000     # Inter-chunk gaps kept per streamed response
+}
+
+capture_buffer = []
+
+def record_capture(request, status_code, response_bytes=0, chunk_gaps_ms=None, usage=None):
+    """
+    Append a redacted capture record for a finished request to the in-memory buffer
+
+    Only sizes, counts, timings and statuses are recorded. The user header is
+    replaced by a short SHA-256 digest unless CAPTURE_REDACT_USER=false.
+    """
+    if not CAPTURE_CONFIG["enabled"]:
+        return
+
+    state = request.state
+    user = request.headers.get(USAGE_CONFIG["user_header"])
+    if user and CAPTURE_CONFIG["redact_user"]:
+        user = hashlib.sha256(user.encode("utf-8")).hexdigest()[:16]
+    started_at = getattr(state, "started_at", None)
+    usage = usage or {}
+
+    capture_buffer.append({
+        "ts": round(getattr(state, "received_at", time.time()), 3),
+        "model": getattr(state, "model_id", None),
+        "stream": bool(getattr(state, "stream", False)),
+        "user": user,
+        "request_bytes": getattr(state, "request_bytes", 0),
+        "messages": getattr(state, "message_count", 0),
+        "max_tokens": getattr(state, "max_tokens", None),
+        "estimated_prompt_tokens": getattr(state, "estimated_prompt_tokens", None),
+        "upstream_statuses": getattr(state, "upstream_statuses", []),
+        "status": status_code,
+        "response_bytes": response_bytes,
+        "ttfb_ms": getattr(state, "ttfb_ms", None),
+        "latency_ms": round((time.perf_counter() - started_at) * 1000, 1) if started_at else None,
+        "chunk_gaps_ms": (chunk_gaps_ms or [])[:CAPTURE_CONFIG["max_chunk_gaps"]],
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens")
+    })
+
+def write_capture_batch(batch):
+    """Append a batch of capture records to the JSONL file (runs in a worker thread)"""
+    with open(CAPTURE_CONFIG["file_path"], "ab") as capture_file:
+        capture_file.write(b"".join(json_dumps(record) + b"\n" for record in batch))
+
+async def flush_capture():
+    """Flush buffered capture records without blocking the event loop"""
+    if not capture_buffer:
+        return
+
+    batch = capture_buffer[:]
+    del capture_buffer[:len(batch)]
+    try:
+        await asyncio.to_thread(write_capture_batch, batch)
+    except Exception as e:
+        print(f"Warning: Could not write {len(batch)} capture record(s): {e}")
+
 def upload_base64_to_gcs(base64_data, image_format="png"):
     """
     Upload base64 image to GCS and return gs:// URL
@@ -253,34 +1210,36 @@ def upload_base64_to_gcs(base64_data, image_format="png"):
     Raises:
         Exception: If upload fails
     """
-    try:
-        # Decode base64 to binary
-        image_bytes = base64.b64decode(base64_data)
+    with tracer.start_as_current_span("ocr.upload", attributes={"image.format": image_format}) as upload_span:
+        try:
+            # Decode base64 to binary
+            image_bytes = base64.b64decode(base64_data)
 
-        # Generate unique filename
-        unique_id = str(uuid.uuid4())
-        blob_name = f"{GCS_TEMP_PREFIX}{unique_id}.{image_format}"
+            # Generate unique filename
+            unique_id = str(uuid.uuid4())
+            blob_name = f"{GCS_TEMP_PREFIX}{unique_id}.{image_format}"
 
-        # Get GCS client and bucket
-        client = get_gcs_client()
-        bucket = client.bucket(GCS_BUCKET_NAME)
-        blob = bucket.blob(blob_name)
+            # Get GCS client and bucket
+            client = get_gcs_client()
+            bucket = client.bucket(GCS_BUCKET_NAME)
+            blob = bucket.blob(blob_name)
 
-        # Upload with content type
-        content_type = f"image/{image_format}"
-        blob.upload_from_string(image_bytes, content_type=content_type)
+            # Upload with content type
+            content_type = f"image/{image_format}"
+            blob.upload_from_string(image_bytes, content_type=content_type)
 
-        # Generate gs:// URL
-        gs_url = f"gs://{GCS_BUCKET_NAME}/{blob_name}"
+            # Generate gs:// URL
+            gs_url = f"gs://{GCS_BUCKET_NAME}/{blob_name}"
 
-        size_kb = len(image_bytes) / 1024
-        print(f"DeepSeek OCR: Uploaded image to GCS ({size_kb:.1f}KB): {gs_url}")
+            size_kb = len(image_bytes) / 1024
+            upload_span.set_attribute("image.size_bytes", len(image_bytes))
+            print(f"DeepSeek OCR: Uploaded image to GCS ({size_kb:.1f}KB): {gs_url}")
 
-        return gs_url, blob_name
+            return gs_url, blob_name
 
-    except Exception as e:
-        print(f"Error uploading to GCS: {e}")
-        raise
+        except Exception as e:
+            print(f"Error uploading to GCS: {e}")
+            raise
 
 def delete_from_gcs(blob_name):
     """
@@ -434,10 +1393,364 @@ def transform_deepseek_ocr_images(body):
 
     return body, uploaded_blobs
 
+def split_ocr_pages(body):
+    """
+    Split a DeepSeek OCR request into one request body per image (page)
+
+    Text-only messages (string content) are kept in every page, like the
+    single-request transform does; text parts next to images are dropped
+    later by transform_deepseek_ocr_images.
+
+    Args:
+        body: Request body dict containing messages
+
+    Returns:
+        list: Page request bodies in page order (empty if below min_pages)
+    """
+    messages = body.get("messages") or []
+    shared_messages = [message for message in messages if not isinstance(message.get("content"), list)]
+    images = [
+        item
+        for message in messages if isinstance(message.get("content"), list)
+        for item in message["content"] if isinstance(item, dict) and item.get("type") == "image_url"
+    ]
+    if len(images) < OCR_FANOUT_CONFIG["min_pages"]:
+        return []
+
+    # Pages are always fetched non-streaming - the proxy does the streaming across pages
+    shared_fields = {key: value for key, value in body.items() if key not in ("messages", "stream", "stream_options")}
+    return [
+        {**shared_fields, "stream": False, "messages": shared_messages + [{"role": "user", "content": [image]}]}
+        for image in images
+    ]
+
+async def ocr_page_completion(request, page_number, page_body, headers, semaphore):
+    """
+    Run one OCR page: upload its image, send it with retries and failover, clean up
+
+    Args:
+        request: Incoming request (upstream attempts are appended to its state)
+        page_number: 1-based page number
+        page_body: Page request body from split_ocr_pages
+        headers: Upstream request headers (authorization)
+        semaphore: Bounds the pages in flight for this request
+
+    Returns:
+        dict: page, status ("ok" or "error"), content, usage, model, region,
+        attempts, and error/status_code for failed pages
+    """
+    result = {
+        "page": page_number, "status": "error", "content": "", "usage": None, "model": None,
+        "region": None, "attempts": 0, "error": None, "status_code": 502
+    }
+    uploaded_blobs = []
+
+    async with semaphore:
+        with tracer.start_as_current_span("ocr.page", attributes={"ocr.page": page_number}) as page_span:
+            try:
+                page_body, uploaded_blobs = await asyncio.to_thread(transform_deepseek_ocr_images, page_body)
+
+                endpoint, is_pooled = select_endpoint("deepseek-ocr")
+                endpoints_to_try = [endpoint]
+                if is_pooled:
+                    endpoints_to_try += [ep for ep in MODEL_ENDPOINTS["deepseek-ocr"] if ep != endpoint]
+
+                for attempt in range(OCR_FANOUT_CONFIG["page_retries"] + 1):
+                    # Rotate through the pool so retries also fail over between regions
+                    current_endpoint = endpoints_to_try[attempt % len(endpoints_to_try)]
+                    region = endpoint_region(current_endpoint)
+                    attempt_attributes = {
+                        "vertex.region": region,
+                        "vertex.endpoint_index": attempt % len(endpoints_to_try),
+                        "retry.attempt": attempt,
+                        "ocr.page": page_number
+                    }
+                    with tracer.start_as_current_span("upstream.attempt", attributes=attempt_attributes) as attempt_span:
+                        if attempt > 0:
+                            delay = calculate_retry_delay(attempt - 1)
+                            print(f"DeepSeek OCR page {page_number}: retry {attempt}/{OCR_FANOUT_CONFIG['page_retries']} in {delay:.1f}s ({region})")
+                            with tracer.start_as_current_span("retry.backoff", attributes={"retry.delay_seconds": delay}):
+                                await asyncio.sleep(delay)
+
+                        page_body["model"] = current_endpoint["model"]
+                        result["attempts"] += 1
+                        result["region"] = region
+                        dispatch_time = time.perf_counter()
+                        try:
+                            response = await get_http_client().post(current_endpoint["url"], content=json_dumps(page_body), headers=headers)
+                        except Exception as e:
+                            request.state.upstream_statuses.append({"region": region, "status": None, "error": type(e).__name__})
+                            record_endpoint_outcome("deepseek-ocr", current_endpoint, False)
+                            result["error"] = f"Request error ({region}): {e}"
+                            print(f"DeepSeek OCR page {page_number}: {result['error']}")
+                            attempt_span.record_exception(e)
+                            attempt_span.set_status(Status(StatusCode.ERROR, result["error"][:200]))
+                            attempt_span.set_attribute("error.type", type(e).__name__)
+                            continue
+
+                        response_time_ms = round((time.perf_counter() - dispatch_time) * 1000, 1)
+                        attempt_span.set_attribute("http.status_code", response.status_code)
+                        attempt_span.set_attribute("http.response_time_ms", response_time_ms)
+                        request.state.upstream_statuses.append({"region": region, "status": response.status_code})
+                        record_endpoint_outcome(
+                            "deepseek-ocr", current_endpoint,
+                            response.status_code < 500 and response.status_code != 429,
+                            response_time_ms
+                        )
+
+                        if response.status_code == 200:
+                            response_json = json_loads(response.content)
+                            message = (response_json.get("choices") or [{}])[0].get("message") or {}
+                            result.update(
+                                status="ok", content=message.get("content") or "", usage=response_json.get("usage"),
+                                model=response_json.get("model"), error=None, status_code=200
+                            )
+                            return result
+
+                        attempt_span.set_status(Status(StatusCode.ERROR, f"HTTP {response.status_code}"))
+                        result["error"] = f"Error from Vertex AI ({region}): {response.status_code} - {response.text[:500]}"
+                        result["status_code"] = response.status_code
+                        print(f"DeepSeek OCR page {page_number}: {result['error']}")
+
+                    # Non-retryable errors (e.g., 400) only move on to endpoints not tried yet
+                    if response.status_code not in [429, 500, 503] and attempt + 1 >= len(endpoints_to_try):
+                        break
+
+                return result
+
+            except ValueError as e:
+                result["error"] = f"Image transformation error: {str(e)}"
+                result["status_code"] = 400
+                return result
+            except Exception as e:
+                print(f"DeepSeek OCR page {page_number} failed: {e}")
+                result["error"] = str(e)
+                return result
+            finally:
+                page_span.set_attribute("ocr.page_status", result["status"])
+                page_span.set_attribute("retry.attempts", result["attempts"])
+                if result["status"] != "ok":
+                    page_span.set_status(Status(StatusCode.ERROR, (result["error"] or "")[:200]))
+                for blob_name in uploaded_blobs:
+                    await asyncio.to_thread(delete_from_gcs, blob_name)
+
+def merge_ocr_usage(results):
+    """Sum the token usage of all successful pages (None if no page reported usage)"""
+    usages = [result["usage"] for result in results if result["status"] == "ok" and isinstance(result["usage"], dict)]
+    if not usages:
+        return None
+    return {
+        key: sum(usage.get(key) or 0 for usage in usages)
+        for key in ("prompt_tokens", "completion_tokens", "total_tokens")
+    }
+
+def ocr_page_summary(result):
+    """Per-page status included in merged OCR responses"""
+    summary = {"page": result["page"], "status": result["status"], "region": result["region"], "attempts": result["attempts"]}
+    if result["status"] != "ok":
+        summary["error"] = result["error"]
+    return summary
+
+async def ocr_fanout_completion(request, request_span, pages, stream):
+    """
+    Serve a multi-page DeepSeek OCR request as concurrent per-page requests
+
+    Pages are dispatched with bounded parallelism (max_concurrency) and merged
+    in page order into one OpenAI-compatible response. A failed page does not
+    fail the request: it is listed in "ocr_pages" with its error, and only a
+    request where every page fails returns an error.
+
+    In streaming mode each page is emitted as soon as it and all earlier pages
+    have completed, so the client sees the text in page order.
+
+    Args:
+        request: Incoming request
+        request_span: Request span (ended here for streaming responses)
+        pages: Page request bodies from split_ocr_pages
+        stream: Whether the client asked for a streaming response
+
+    Returns:
+        JSONResponse or StreamingResponse
+    """
+    request_span.set_attribute("ocr.pages", len(pages))
+    print(f"DeepSeek OCR: Fanning out {len(pages)} pages (max {OCR_FANOUT_CONFIG['max_concurrency']} in flight)")
+
+    with tracer.start_as_current_span("token.acquire") as token_span:
+        token_span.set_attribute("token.cached", bool(token_cache["token"]) and time.time() < token_cache["expires_at"])
+        access_token = get_access_token()
+
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json"
+    }
+
+    request.state.upstream_statuses = []
+    request.state.upstream_model = endpoint_model = select_endpoint("deepseek-ocr")[0]["model"]
+    dispatch_time = time.perf_counter()
+    semaphore = asyncio.Semaphore(OCR_FANOUT_CONFIG["max_concurrency"])
+    tasks = [
+        asyncio.create_task(ocr_page_completion(request, page_number, page_body, headers, semaphore))
+        for page_number, page_body in enumerate(pages, 1)
+    ]
+
+    def finish(results):
+        """Record per-request state once all pages are done"""
+        succeeded = [result for result in results if result["status"] == "ok"]
+        request.state.attempts = sum(result["attempts"] for result in results)
+        request.state.vertex_region = (succeeded or results)[0]["region"]
+        request.state.usage = merge_ocr_usage(results)
+        request_span.set_attribute("ocr.failed_pages", len(results) - len(succeeded))
+        print(f"DeepSeek OCR: {len(succeeded)}/{len(results)} pages succeeded in {(time.perf_counter() - dispatch_time) * 1000:.0f}ms")
+        return succeeded
+
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+
+    if not stream:
+        results = await asyncio.gather(*tasks)
+        request.state.ttfb_ms = round((time.perf_counter() - dispatch_time) * 1000, 1)
+        succeeded = finish(results)
+        if not succeeded:
+            raise HTTPException(status_code=results[0]["status_code"], detail=results[0]["error"])
+
+        return JSONResponse(content={
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": succeeded[0]["model"] or endpoint_model,
+            "choices": [{
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": OCR_FANOUT_CONFIG["page_separator"].join(result["content"] for result in succeeded)
+                },
+                "finish_reason": "stop"
+            }],
+            "usage": request.state.usage,
+            "ocr_pages": [ocr_page_summary(result) for result in results]
+        })
+
+    async def generate():
+        status_code = 200
+        byte_count = 0
+        results = []
+
+        def event(delta, finish_reason=None, **extra):
+            nonlocal byte_count
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": endpoint_model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                **extra
+            }
+            data = b"data: " + json_dumps(chunk) + b"\n\n"
+            byte_count += len(data)
+            return data
+
+        try:
+            yield event({"role": "assistant", "content": ""})
+            for task in tasks:
+                result = await task
+                results.append(result)
+                if not hasattr(request.state, "ttfb_ms"):
+                    request.state.ttfb_ms = round((time.perf_counter() - dispatch_time) * 1000, 1)
+                content = result["content"]
+                if result["status"] == "ok" and any(previous["status"] == "ok" for previous in results[:-1]):
+                    content = OCR_FANOUT_CONFIG["page_separator"] + content
+                yield event({"content": content}, ocr_page=ocr_page_summary(result))
+
+            if not finish(results):
+                status_code = results[0]["status_code"]
+                yield f"data: {json.dumps({'error': results[0]['error']})}\n\n".encode("utf-8")
+            else:
+                yield event({}, "stop", usage=request.state.usage)
+            yield b"data: [DONE]\n\n"
+
+        except Exception as e:
+            print(f"DeepSeek OCR streaming error: {e}")
+            status_code = 502
+            yield f"data: {json.dumps({'error': str(e)})}\n\n".encode("utf-8")
+        finally:
+            # Client disconnected or failed - stop pages that have not run yet
+            for task in tasks:
+                task.cancel()
+            request_span.set_attribute("http.status_code", status_code)
+            request_span.end()
+            usage = getattr(request.state, "usage", None)
+            record_usage(request, status_code, usage)
+            record_capture(request, status_code, byte_count, usage=usage)
+
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
+def overall_health():
+    """
+    Summarize endpoint health per model and overall
+
+    Model status is "healthy" if every endpoint is healthy (or not yet observed),
+    "degraded" if some endpoints are degraded or down, "down" if all are down.
+    Overall status is "unhealthy" when every model is down.
+
+    Returns:
+        tuple: (overall status, dict of model_id -> {"status", "endpoints"})
+    """
+    models = {}
+    for model_id, model_endpoints in MODEL_ENDPOINTS.items():
+        reports = [
+            endpoint_health_report(model_id, endpoint)
+            for endpoint in (model_endpoints if isinstance(model_endpoints, list) else [model_endpoints])
+        ]
+        states = {report["state"] for report in reports}
+        if states <= {"healthy", "unknown"}:
+            model_status = "healthy"
+        elif states == {"down"}:
+            model_status = "down"
+        else:
+            model_status = "degraded"
+        models[model_id] = {"status": model_status, "endpoints": reports}
+
+    statuses = {model["status"] for model in models.values()}
+    if statuses == {"healthy"}:
+        status = "healthy"
+    elif statuses == {"down"}:
+        status = "unhealthy"
+    else:
+        status = "degraded"
+
+    return status, models
+
 @app.get("/health")
 async def health():
-    """Health check endpoint - returns available models"""
-    return {"status": "healthy", "models": list(MODEL_ENDPOINTS.keys())}
+    """
+    Health check endpoint - returns available models and per-endpoint health
+
+    Always returns HTTP 200 so it can be used as a liveness probe - an upstream
+    outage must not get the proxy restarted. /ready takes the replica out of
+    rotation instead.
+    """
+    status, models = overall_health()
+    content = {
+        "status": status,
+        "models": list(MODEL_ENDPOINTS.keys()),
+        "model_health": models,
+        "probes_last_hour": len(probe_history),
+        "probe_budget_per_hour": HEALTH_CONFIG["probe_budget_per_hour"] if HEALTH_CONFIG["probe_mode"] == "synthetic" else 0
+    }
+    return content
+
+@app.get("/ready")
+async def ready():
+    """
+    Readiness probe - 200 once warm-up has completed and some model can be served
+
+    Returns 503 before warm-up completes and while every model is down, so the
+    replica leaves rotation without being restarted. Use /health for liveness
+    and /ready for routing traffic (e.g. Kubernetes readinessProbe)
+    """
+    status, _ = overall_health()
+    ready = warmup_state["ready"] and status != "unhealthy"
+    return JSONResponse(status_code=200 if ready else 503, content={**warmup_state, "health": status})
 
 @app.get("/token-status")
 async def token_status():
@@ -476,6 +1789,45 @@ async def retry_config():
         "jitter_info": f"±{int(RETRY_CONFIG['jitter_factor'] * 100)}% random variation" if RETRY_CONFIG["jitter"] else "Disabled"
     }
 
+@app.get("/usage")
+async def usage(group_by: str = "model", window: str = "24h", model: str = None, region: str = None, user: str = None):
+    """
+    Token usage rollups from the accounting ledger
+
+    Query parameters:
+        group_by: Comma-separated dimensions (model, region, user, status, hour, day)
+        window: Time window to aggregate (e.g. 30m, 24h, 7d)
+        model, region, user: Optional exact-match filters
+    """
+    if not USAGE_CONFIG["enabled"]:
+        raise HTTPException(status_code=404, detail="Usage accounting is disabled")
+
+    dimensions = [key.strip() for key in group_by.split(",") if key.strip()]
+    unknown = [key for key in dimensions if key not in USAGE_GROUP_COLUMNS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown group_by dimension(s): {', '.join(unknown)} (valid: {', '.join(USAGE_GROUP_COLUMNS)})"
+        )
+
+    try:
+        window_seconds = parse_time_window(window)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    filters = {column: value for column, value in {"model": model, "region": region, "user": user}.items() if value}
+
+    # Include records still waiting in the buffer
+    await flush_usage()
+    rows = await asyncio.to_thread(query_usage, dimensions, time.time() - window_seconds, filters)
+
+    return {
+        "window": window,
+        "group_by": dimensions,
+        "filters": filters,
+        "data": rows
+    }
+
 @app.get("/v1/models")
 async def list_models():
     """OpenAI-compatible models endpoint"""
@@ -494,40 +1846,130 @@ async def chat_completions(request: Request):
     OpenAI-compatible chat completions endpoint with model pooling
     Handles both streaming and non-streaming requests
     Supports automatic failover between multiple endpoints
+
+    Each request is traced as a "chat_completions" span, continuing the W3C
+    trace context from the incoming headers (traceparent/tracestate)
     """
+    # Nest under an existing server span (ASGI instrumentation) if there is one
+    if trace.get_current_span().get_span_context().is_valid:
+        parent_context = None
+    else:
+        parent_context = extract(request.headers)
+
+    request_span = tracer.start_span(
+        "chat_completions",
+        context=parent_context,
+        kind=SpanKind.SERVER,
+        attributes={"http.route": request.url.path}
+    )
+
+    request.state.received_at = time.time()
+    request.state.started_at = time.perf_counter()
+
     try:
-        body = await request.json()
+        with trace.use_span(request_span, end_on_exit=False):
+            response = await proxy_chat_completion(request, request_span)
+    except HTTPException as e:
+        request_span.set_attribute("http.status_code", e.status_code)
+        request_span.set_status(Status(StatusCode.ERROR, str(e.detail)[:200]))
+        request_span.end()
+        record_usage(request, e.status_code)
+        record_capture(request, e.status_code)
+        raise
+
+    request_span.set_attribute("http.status_code", response.status_code)
+
+    # Streaming responses end the request span and record usage when the stream completes
+    if not isinstance(response, StreamingResponse):
+        request_span.end()
+        record_usage(request, response.status_code, getattr(request.state, "usage", None))
+        record_capture(request, response.status_code, len(response.body), usage=getattr(request.state, "usage", None))
+
+    return response
+
+async def proxy_chat_completion(request, request_span):
+    """
+    Forward a chat completion request to Vertex AI with retries and failover
+
+    Returns a StreamingResponse for streaming requests (which ends
+    request_span when the stream finishes) or a buffered response otherwise
+    """
+    try:
+        # Keep the raw bytes so the request can be forwarded without re-encoding
+        raw_body = await request.body()
+        try:
+            body = json_loads(raw_body)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON body: {str(e)}")
+
+        if not isinstance(body, dict):
+            raise HTTPException(status_code=400, detail="Request body must be a JSON object")
+
         model_id = body.get("model")
 
         if model_id not in MODEL_ENDPOINTS:
             raise HTTPException(status_code=404, detail=f"Model {model_id} not found")
 
+        request_span.set_attribute("llm.model", model_id)
+        request.state.model_id = model_id
+        request.state.stream = bool(body.get("stream", False))
+        request.state.request_bytes = len(raw_body)
+        request.state.message_count = len(body.get("messages") or [])
+        request.state.max_tokens = body.get("max_tokens") or body.get("max_completion_tokens")
+        request_span.set_attribute("llm.stream", bool(body.get("stream", False)))
+
+        # Multi-page DeepSeek OCR: one upstream request per page, dispatched concurrently
+        if model_id == "deepseek-ocr" and OCR_FANOUT_CONFIG["enabled"]:
+            pages = split_ocr_pages(body)
+            if pages:
+                return await ocr_fanout_completion(request, request_span, pages, request.state.stream)
+
         # Transform images for DeepSeek OCR (converts OpenAI format to DeepSeek format)
         uploaded_blobs = []  # Track GCS uploads for cleanup
         if model_id == "deepseek-ocr":
-            try:
-                # Log the BEFORE state
-                import json as json_lib
-                print("=" * 80)
-                print("DeepSeek OCR: REQUEST BEFORE TRANSFORMATION")
-                print(json_lib.dumps(body.get("messages", []), indent=2, ensure_ascii=False)[:2000])
-                print("=" * 80)
-
-                body, uploaded_blobs = transform_deepseek_ocr_images(body)
-
-                # Log the AFTER state
-                print("=" * 80)
-                print("DeepSeek OCR: REQUEST AFTER TRANSFORMATION")
-                print(json_lib.dumps(body.get("messages", []), indent=2, ensure_ascii=False)[:2000])
-                print("=" * 80)
-            except ValueError as e:
-                raise HTTPException(status_code=400, detail=f"Image transformation error: {str(e)}")
-            except Exception as e:
-                print(f"Unexpected error in image transformation: {e}")
-                raise HTTPException(status_code=500, detail=f"Image processing failed: {str(e)}")
+            with tracer.start_as_current_span("ocr.transform"):
+                try:
+                    # Log the BEFORE state
+                    import json as json_lib
+                    print("=" * 80)
+                    print("DeepSeek OCR: REQUEST BEFORE TRANSFORMATION")
+                    print(json_lib.dumps(body.get("messages", []), indent=2, ensure_ascii=False)[:2000])
+                    print("=" * 80)
+
+                    body, uploaded_blobs = transform_deepseek_ocr_images(body)
+
+                    # Log the AFTER state
+                    print("=" * 80)
+                    print("DeepSeek OCR: REQUEST AFTER TRANSFORMATION")
+                    print(json_lib.dumps(body.get("messages", []), indent=2, ensure_ascii=False)[:2000])
+                    print("=" * 80)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=f"Image transformation error: {str(e)}")
+                except Exception as e:
+                    print(f"Unexpected error in image transformation: {e}")
+                    raise HTTPException(status_code=500, detail=f"Image processing failed: {str(e)}")
+
+        # Pre-flight context budget check (fast 400 instead of a Vertex AI round-trip)
+        try:
+            if len(raw_body) > CONTEXT_CONFIG["offload_bytes"]:
+                estimated_prompt_tokens, trimmed_messages = await asyncio.to_thread(
+                    enforce_context_budget, model_id, body, len(raw_body)
+                )
+            else:
+                estimated_prompt_tokens, trimmed_messages = enforce_context_budget(model_id, body, len(raw_body))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Context length exceeded: {str(e)}")
+        request.state.estimated_prompt_tokens = estimated_prompt_tokens
+        if estimated_prompt_tokens is not None:
+            request_span.set_attribute("llm.estimated_prompt_tokens", estimated_prompt_tokens)
+            request_span.set_attribute("llm.trimmed_messages", trimmed_messages)
 
         # Select endpoint (with load balancing if multiple endpoints available)
-        endpoint, is_pooled = select_endpoint(model_id)
+        with tracer.start_as_current_span("endpoint.select") as select_span:
+            endpoint, is_pooled = select_endpoint(model_id)
+            select_span.set_attribute("vertex.pooled", is_pooled)
+            if endpoint:
+                select_span.set_attribute("vertex.region", endpoint_region(endpoint))
 
         if not endpoint:
             raise HTTPException(status_code=500, detail=f"No endpoints available for model {model_id}")
@@ -539,7 +1981,9 @@ async def chat_completions(request: Request):
         body["model"] = endpoint["model"]
 
         # Get OAuth2 token
-        access_token = get_access_token()
+        with tracer.start_as_current_span("token.acquire") as token_span:
+            token_span.set_attribute("token.cached", bool(token_cache["token"]) and time.time() < token_cache["expires_at"])
+            access_token = get_access_token()
 
         headers = {
             "Authorization": f"Bearer {access_token}",
@@ -549,8 +1993,8 @@ async def chat_completions(request: Request):
         # Check if streaming is requested
         stream = body.get("stream", False)
 
-        # Create persistent client
-        client = httpx.AsyncClient(timeout=600.0)
+        # Shared client with pooled connections (pre-opened during warm-up)
+        client = get_http_client()
 
         # For pooled models, implement failover logic
         endpoints_to_try = []
@@ -563,206 +2007,298 @@ async def chat_completions(request: Request):
 
         last_error = None
         retry_count = 0
+        request.state.upstream_statuses = []  # (region, status) per attempt, for traffic capture
+
+        # Upstream request bodies, keyed by Vertex AI model ID
+        # The OCR transform and history trimming mutate the parsed body, so it has to be re-encoded;
+        # every other request is forwarded as the client's raw bytes with only the model patched
+        body_transformed = original_model_id == "deepseek-ocr" or trimmed_messages > 0
+        upstream_payloads = {}
 
         for endpoint_num, current_endpoint in enumerate(endpoints_to_try):
             # Each endpoint gets max_retries + 1 attempts (initial + retries)
             max_attempts = RETRY_CONFIG["max_retries"] + 1
 
             for retry_attempt in range(max_attempts):
-                try:
-                    # Update URL and model for current endpoint
-                    current_url = current_endpoint["url"]
-                    body["model"] = current_endpoint["model"]
-                    region = current_endpoint.get("region", "unknown")
-
-                    # Log attempt information
-                    if endpoint_num > 0 and retry_attempt == 0:
-                        print(f"Failover to endpoint {endpoint_num + 1}/{len(endpoints_to_try)}: trying region {region}")
-                    elif retry_attempt > 0:
-                        print(f"Retry attempt {retry_attempt}/{RETRY_CONFIG['max_retries']} for region {region}")
-
-                    # Apply exponential backoff delay before retry (not on first attempt)
-                    if retry_attempt > 0:
-                        delay = calculate_retry_delay(retry_attempt - 1)
-                        print(f"Waiting {delay:.1f}s before retry (exponential backoff)...")
-                        await asyncio.sleep(delay)
-
-                    retry_count += 1
-
-                    if stream:
-                        # Streaming response - start stream without context manager to keep it open
-                        stream_response = client.stream(
-                            "POST",
-                            current_url,
-                            json=body,
-                            headers=headers
-                        )
-                        response = await stream_response.__aenter__()
-
-                        if response.status_code != 200:
-                            error_text = await response.aread()
-                            await stream_response.__aexit__(None, None, None)
-                            error_msg = f"Error from Vertex AI ({region}): {response.status_code} - {error_text.decode()}"
-                            print(error_msg)
-                            last_error = error_msg
-
-                            # Retry on 429, 503, 500 errors (retryable errors)
-                            if response.status_code in [429, 500, 503]:
-                                # Try next retry attempt if available
-                                if retry_attempt < RETRY_CONFIG["max_retries"]:
-                                    continue
-
-                                # Max retries reached for this endpoint, try next endpoint
-                                if endpoint_num < len(endpoints_to_try) - 1:
-                                    break  # Break retry loop, continue to next endpoint
-
-                            # Non-retryable error (e.g., 400, 404) or all retries exhausted
-                            # For non-retryable errors, immediately try next endpoint if available
-                            if endpoint_num < len(endpoints_to_try) - 1:
-                                break  # Try next endpoint without retrying
-
-                            # No more endpoints to try
-                            await client.aclose()
-
-                            # Cleanup GCS temp files
-                            if uploaded_blobs:
-                                print(f"DEBUG: Cleaning up {len(uploaded_blobs)} GCS files (error)")
-                                for blob_name in uploaded_blobs:
-                                    delete_from_gcs(blob_name)
-
-                            raise HTTPException(
-                                status_code=response.status_code,
-                                detail=error_text.decode()
+                attempt_attributes = {
+                    "vertex.region": endpoint_region(current_endpoint),
+                    "vertex.endpoint_index": endpoint_num,
+                    "retry.attempt": retry_attempt
+                }
+                with tracer.start_as_current_span("upstream.attempt", attributes=attempt_attributes) as attempt_span:
+                    try:
+                        # Update URL and model for current endpoint
+                        current_url = current_endpoint["url"]
+                        body["model"] = current_endpoint["model"]
+                        region = endpoint_region(current_endpoint)
+
+                        payload = upstream_payloads.get(body["model"])
+                        if payload is None:
+                            if body_transformed:
+                                payload = json_dumps(body)
+                            else:
+                                payload = patch_model_field(raw_body, body, original_model_id, body["model"])
+                            upstream_payloads[body["model"]] = payload
+
+                        # Log attempt information
+                        if endpoint_num > 0 and retry_attempt == 0:
+                            print(f"Failover to endpoint {endpoint_num + 1}/{len(endpoints_to_try)}: trying region {region}")
+                        elif retry_attempt > 0:
+                            print(f"Retry attempt {retry_attempt}/{RETRY_CONFIG['max_retries']} for region {region}")
+
+                        # Apply exponential backoff delay before retry (not on first attempt)
+                        if retry_attempt > 0:
+                            delay = calculate_retry_delay(retry_attempt - 1)
+                            print(f"Waiting {delay:.1f}s before retry (exponential backoff)...")
+                            with tracer.start_as_current_span("retry.backoff", attributes={"retry.delay_seconds": delay}):
+                                await asyncio.sleep(delay)
+
+                        retry_count += 1
+                        dispatch_time = time.perf_counter()
+                        request.state.attempts = retry_count
+                        request.state.vertex_region = region
+                        request.state.upstream_model = body["model"]
+
+                        if stream:
+                            # Streaming response - start stream without context manager to keep it open
+                            stream_response = client.stream(
+                                "POST",
+                                current_url,
+                                content=payload,
+                                headers=headers
+                            )
+                            response = await stream_response.__aenter__()
+
+                            # Headers received - this attempt span measures time to first byte
+                            attempt_span.set_attribute("http.status_code", response.status_code)
+                            request.state.upstream_statuses.append({"region": region, "status": response.status_code})
+                            record_endpoint_outcome(
+                                original_model_id, current_endpoint,
+                                response.status_code < 500 and response.status_code != 429,
+                                (time.perf_counter() - dispatch_time) * 1000
                             )
 
-                        # Success! Stream the response
-                        print(f"Request succeeded after {retry_count} total attempt(s)")
-                        print(f"DEBUG: original_model_id = '{original_model_id}', streaming = True")
-
-                        async def generate():
-                            captured_response = []  # Capture response for DeepSeek OCR debugging
-                            try:
-                                async for chunk in response.aiter_bytes():
-                                    # Capture response for DeepSeek OCR debugging
-                                    if original_model_id == "deepseek-ocr":
-                                        captured_response.append(chunk)
-                                    yield chunk
-
-                                # Log captured response for DeepSeek OCR
-                                if original_model_id == "deepseek-ocr" and captured_response:
-                                    try:
-                                        full_response = b''.join(captured_response).decode('utf-8')
-                                        print("=" * 80)
-                                        print("DeepSeek OCR: STREAMING RESPONSE FROM VERTEX AI")
-                                        print(full_response[:3000])
-                                        print("=" * 80)
-                                    except Exception as e:
-                                        print(f"ERROR: Failed to decode streaming response: {e}")
-
-                            except Exception as e:
-                                print(f"Streaming error ({region}): {e}")
-                                yield f"data: {json.dumps({'error': str(e)})}\n\n"
-                            finally:
-                                # Close the stream context manager
+                            if response.status_code != 200:
+                                attempt_span.set_status(Status(StatusCode.ERROR, f"HTTP {response.status_code}"))
+                                error_text = await response.aread()
                                 await stream_response.__aexit__(None, None, None)
-                                await client.aclose()
+                                error_msg = f"Error from Vertex AI ({region}): {response.status_code} - {error_text.decode()}"
+                                print(error_msg)
+                                last_error = error_msg
+
+                                # Retry on 429, 503, 500 errors (retryable errors)
+                                if response.status_code in [429, 500, 503]:
+                                    # Try next retry attempt if available
+                                    if retry_attempt < RETRY_CONFIG["max_retries"]:
+                                        continue
+
+                                    # Max retries reached for this endpoint, try next endpoint
+                                    if endpoint_num < len(endpoints_to_try) - 1:
+                                        break  # Break retry loop, continue to next endpoint
+
+                                # Non-retryable error (e.g., 400, 404) or all retries exhausted
+                                # For non-retryable errors, immediately try next endpoint if available
+                                if endpoint_num < len(endpoints_to_try) - 1:
+                                    break  # Try next endpoint without retrying
+
+                                # No more endpoints to try
 
-                                # Cleanup GCS temp files for DeepSeek OCR
+                                # Cleanup GCS temp files
                                 if uploaded_blobs:
-                                    print(f"DEBUG: Cleaning up {len(uploaded_blobs)} GCS files (streaming)")
+                                    print(f"DEBUG: Cleaning up {len(uploaded_blobs)} GCS files (error)")
                                     for blob_name in uploaded_blobs:
                                         delete_from_gcs(blob_name)
 
-                        return StreamingResponse(generate(), media_type="text/event-stream")
-                    else:
-                        # Non-streaming response
-                        response = await client.post(
-                            current_url,
-                            json=body,
-                            headers=headers
-                        )
-
-                        if response.status_code != 200:
-                            error_msg = f"Error from Vertex AI ({region}): {response.status_code} - {response.text}"
-                            print(error_msg)
-                            last_error = error_msg
+                                raise HTTPException(
+                                    status_code=response.status_code,
+                                    detail=error_text.decode()
+                                )
+
+                            # Success! Stream the response
+                            print(f"Request succeeded after {retry_count} total attempt(s)")
+                            print(f"DEBUG: original_model_id = '{original_model_id}', streaming = True")
+
+                            async def generate():
+                                captured_response = []  # Capture response for DeepSeek OCR debugging
+                                stream_span = tracer.start_span(
+                                    "upstream.stream",
+                                    context=trace.set_span_in_context(request_span),
+                                    attributes={"vertex.region": region}
+                                )
+                                chunk_count = 0
+                                byte_count = 0
+                                stream_tail = b""  # Last bytes of the stream, where the usage block is sent
+                                chunk_gaps_ms = []  # Inter-chunk timing, for traffic capture
+                                last_chunk_time = None
+                                status_code = 200
+                                try:
+                                    async for chunk in response.aiter_bytes():
+                                        chunk_time = time.perf_counter()
+                                        if chunk_count == 0:
+                                            request.state.ttfb_ms = round((chunk_time - dispatch_time) * 1000, 1)
+                                            stream_span.set_attribute("stream.time_to_first_chunk_ms", request.state.ttfb_ms)
+                                        elif CAPTURE_CONFIG["enabled"]:
+                                            chunk_gaps_ms.append(round((chunk_time - last_chunk_time) * 1000, 1))
+                                        last_chunk_time = chunk_time
+                                        chunk_count += 1
+                                        byte_count += len(chunk)
+                                        stream_tail = (stream_tail + chunk)[-USAGE_CONFIG["tail_bytes"]:]
+                                        # Capture response for DeepSeek OCR debugging
+                                        if original_model_id == "deepseek-ocr":
+                                            captured_response.append(chunk)
+                                        yield chunk
+
+                                    # Log captured response for DeepSeek OCR
+                                    if original_model_id == "deepseek-ocr" and captured_response:
+                                        try:
+                                            full_response = b''.join(captured_response).decode('utf-8')
+                                            print("=" * 80)
+                                            print("DeepSeek OCR: STREAMING RESPONSE FROM VERTEX AI")
+                                            print(full_response[:3000])
+                                            print("=" * 80)
+                                        except Exception as e:
+                                            print(f"ERROR: Failed to decode streaming response: {e}")
+
+                                except Exception as e:
+                                    print(f"Streaming error ({region}): {e}")
+                                    stream_span.record_exception(e)
+                                    stream_span.set_status(Status(StatusCode.ERROR, str(e)[:200]))
+                                    status_code = 502
+                                    yield f"data: {json.dumps({'error': str(e)})}\n\n"
+                                finally:
+                                    stream_span.set_attribute("stream.chunks", chunk_count)
+                                    stream_span.set_attribute("stream.bytes", byte_count)
+                                    stream_span.end()
+
+                                    # Close the stream context manager
+                                    await stream_response.__aexit__(None, None, None)
+
+                                    # Cleanup GCS temp files for DeepSeek OCR
+                                    if uploaded_blobs:
+                                        print(f"DEBUG: Cleaning up {len(uploaded_blobs)} GCS files (streaming)")
+                                        for blob_name in uploaded_blobs:
+                                            delete_from_gcs(blob_name)
+
+                                    request_span.end()
+                                    stream_usage = extract_usage(stream_tail)
+                                    record_usage(request, status_code, stream_usage)
+                                    record_capture(request, status_code, byte_count, chunk_gaps_ms, stream_usage)
+
+                            return StreamingResponse(
+                                generate(),
+                                media_type="text/event-stream",
+                                headers=passthrough_headers(response)
+                            )
+                        else:
+                            # Non-streaming response
+                            response = await client.post(
+                                current_url,
+                                content=payload,
+                                headers=headers
+                            )
+                            request.state.ttfb_ms = round((time.perf_counter() - dispatch_time) * 1000, 1)
+                            attempt_span.set_attribute("http.status_code", response.status_code)
+                            attempt_span.set_attribute("http.response_time_ms", request.state.ttfb_ms)
+                            request.state.upstream_statuses.append({"region": region, "status": response.status_code})
+                            record_endpoint_outcome(
+                                original_model_id, current_endpoint,
+                                response.status_code < 500 and response.status_code != 429,
+                                request.state.ttfb_ms
+                            )
 
-                            # Retry on 429, 503, 500 errors (retryable errors)
-                            if response.status_code in [429, 500, 503]:
-                                # Try next retry attempt if available
-                                if retry_attempt < RETRY_CONFIG["max_retries"]:
-                                    continue
+                            if response.status_code != 200:
+                                attempt_span.set_status(Status(StatusCode.ERROR, f"HTTP {response.status_code}"))
+                                error_msg = f"Error from Vertex AI ({region}): {response.status_code} - {response.text}"
+                                print(error_msg)
+                                last_error = error_msg
 
-                                # Max retries reached for this endpoint, try next endpoint
-                                if endpoint_num < len(endpoints_to_try) - 1:
-                                    break  # Break retry loop, continue to next endpoint
-
-                            # Non-retryable error (e.g., 400, 404) or all retries exhausted
-                            # For non-retryable errors, immediately try next endpoint if available
-                            if endpoint_num < len(endpoints_to_try) - 1:
-                                break  # Try next endpoint without retrying
-
-                            # No more endpoints to try
-                            await client.aclose()
-                            raise HTTPException(
-                                status_code=response.status_code,
-                                detail=response.text
-                            )
+                                # Retry on 429, 503, 500 errors (retryable errors)
+                                if response.status_code in [429, 500, 503]:
+                                    # Try next retry attempt if available
+                                    if retry_attempt < RETRY_CONFIG["max_retries"]:
+                                        continue
 
-                        # Success!
-                        await client.aclose()
-                        print(f"Request succeeded after {retry_count} total attempt(s)")
+                                    # Max retries reached for this endpoint, try next endpoint
+                                    if endpoint_num < len(endpoints_to_try) - 1:
+                                        break  # Break retry loop, continue to next endpoint
 
-                        # Parse response
-                        try:
-                            response_json = response.json()
-                            print(f"DEBUG: original_model_id = '{original_model_id}', current model = '{body.get('model')}'")
-                            print(f"DEBUG: Response status = {response.status_code}, has JSON = True")
+                                # Non-retryable error (e.g., 400, 404) or all retries exhausted
+                                # For non-retryable errors, immediately try next endpoint if available
+                                if endpoint_num < len(endpoints_to_try) - 1:
+                                    break  # Try next endpoint without retrying
+
+                                # No more endpoints to try
+                                raise HTTPException(
+                                    status_code=response.status_code,
+                                    detail=response.text
+                                )
+
+                            # Success!
+                            print(f"Request succeeded after {retry_count} total attempt(s)")
+
+                            # Fast path: pass the upstream bytes through untouched
+                            # Only DeepSeek OCR responses are parsed (for debug logging and GCS cleanup)
+                            request.state.usage = extract_usage(response.content)
+                            if original_model_id != "deepseek-ocr":
+                                print(f"DEBUG: original_model_id = '{original_model_id}', current model = '{body.get('model')}'")
+                                print(f"DEBUG: Response status = {response.status_code}, passthrough {len(response.content)} bytes")
+                                return Response(
+                                    content=response.content,
+                                    status_code=response.status_code,
+                                    headers=passthrough_headers(response),
+                                    media_type="application/json"
+                                )
+
+                            # Parse response
+                            try:
+                                response_json = json_loads(response.content)
+                                print(f"DEBUG: original_model_id = '{original_model_id}', current model = '{body.get('model')}'")
+                                print(f"DEBUG: Response status = {response.status_code}, has JSON = True")
 
-                            # Log response for DeepSeek OCR debugging
-                            if original_model_id == "deepseek-ocr":
+                                # Log response for DeepSeek OCR debugging
                                 print("=" * 80)
                                 print("DeepSeek OCR: RESPONSE FROM VERTEX AI")
                                 print(json.dumps(response_json, indent=2, ensure_ascii=False)[:3000])
                                 print("=" * 80)
-                            else:
-                                print(f"DEBUG: original_model_id '{original_model_id}' is not 'deepseek-ocr'")
 
-                        except Exception as e:
-                            print(f"ERROR: Failed to parse response JSON: {e}")
-                            print(f"DEBUG: Response text: {response.text[:500]}")
-                            raise
+                            except Exception as e:
+                                print(f"ERROR: Failed to parse response JSON: {e}")
+                                print(f"DEBUG: Response text: {response.text[:500]}")
+                                raise
 
-                        # Cleanup GCS temp files for DeepSeek OCR
-                        if uploaded_blobs:
-                            print(f"DEBUG: Cleaning up {len(uploaded_blobs)} GCS files")
-                            for blob_name in uploaded_blobs:
-                                delete_from_gcs(blob_name)
+                            # Cleanup GCS temp files for DeepSeek OCR
+                            if uploaded_blobs:
+                                print(f"DEBUG: Cleaning up {len(uploaded_blobs)} GCS files")
+                                for blob_name in uploaded_blobs:
+                                    delete_from_gcs(blob_name)
 
-                        return JSONResponse(content=response_json)
+                            return JSONResponse(content=response_json)
 
-                except HTTPException:
-                    await client.aclose()
-                    raise
-                except Exception as e:
-                    error_msg = f"Request error ({region}): {e}"
-                    print(error_msg)
-                    last_error = error_msg
+                    except HTTPException:
+                        raise
+                    except Exception as e:
+                        error_msg = f"Request error ({region}): {e}"
+                        print(error_msg)
+                        # Connection errors and timeouts don't escape the span, so mark the attempt failed here
+                        attempt_span.record_exception(e)
+                        attempt_span.set_status(Status(StatusCode.ERROR, error_msg[:200]))
+                        attempt_span.set_attribute("error.type", type(e).__name__)
+                        request.state.upstream_statuses.append({"region": region, "status": None, "error": type(e).__name__})
+                        record_endpoint_outcome(original_model_id, current_endpoint, False)
+                        last_error = error_msg
 
-                    # Try next retry attempt if available
-                    if retry_attempt < RETRY_CONFIG["max_retries"]:
-                        continue
+                        # Try next retry attempt if available
+                        if retry_attempt < RETRY_CONFIG["max_retries"]:
+                            continue
 
-                    # Max retries reached for this endpoint, try next endpoint
-                    if endpoint_num < len(endpoints_to_try) - 1:
-                        break  # Break retry loop, continue to next endpoint
+                        # Max retries reached for this endpoint, try next endpoint
+                        if endpoint_num < len(endpoints_to_try) - 1:
+                            break  # Break retry loop, continue to next endpoint
 
-                    # No more endpoints to try
-                    await client.aclose()
-                    raise HTTPException(status_code=500, detail=str(e))
+                        # No more endpoints to try
+                        raise HTTPException(status_code=500, detail=str(e))
 
         # Should not reach here, but just in case
-        await client.aclose()
         raise HTTPException(status_code=500, detail=last_error or "All endpoints failed")
 
     except HTTPException:
@@ -0,0 +1,381 @@
+# vertex-proxy/benchmark.py
+# Microbenchmarks for the Vertex AI proxy hot paths
+# Runs locally without GCP credentials or network access
+#
+# Usage:
+#   python benchmark.py json              # JSON request/response handling CPU cost
+#   python benchmark.py tokens            # Pre-flight token estimation cost for large conversations
+#   python benchmark.py usage             # Hot-path cost of usage accounting per request
+#   python benchmark.py startup           # Import time, time to /ready and to first successful request
+#   python benchmark.py ocr               # Multi-page OCR latency: single request vs per-page fan-out
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import app
+
+# Payload sizes (approximate request body size in bytes)
+JSON_PAYLOAD_SIZES = [10_000, 100_000, 1_000_000, 5_000_000]
+
+# Conversation lengths (number of messages) for token estimation
+TOKEN_CONVERSATION_TURNS = [10, 100, 1_000, 5_000]
+
+# Document sizes (number of pages/images) for OCR fan-out
+OCR_PAGE_COUNTS = [1, 10, 50]
+
+
+def build_chat_request(target_size, model="deepseek-v3"):
+    """Build a multi-turn chat request of roughly target_size bytes"""
+    turn_text = "Explain the trade-offs of regional failover for LLM inference. " * 8
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    while len(json.dumps(messages)) < target_size:
+        role = "user" if len(messages) % 2 else "assistant"
+        messages.append({"role": role, "content": turn_text})
+    return json.dumps({"model": model, "messages": messages, "stream": False}).encode("utf-8")
+
+
+def build_chat_response(target_size):
+    """Build an OpenAI-style chat completion response of roughly target_size bytes"""
+    content = "x" * max(target_size - 300, 0)
+    return json.dumps({
+        "id": "chatcmpl-bench",
+        "object": "chat.completion",
+        "model": "deepseek-ai/deepseek-v3.1-maas",
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": 1000, "completion_tokens": 500, "total_tokens": 1500}
+    }).encode("utf-8")
+
+
+def legacy_json_path(raw_request, raw_response, upstream_model):
+    """Original behavior: request.json() + httpx json= + response.json() + JSONResponse"""
+    body = json.loads(raw_request)
+    body["model"] = upstream_model
+    json.dumps(body).encode("utf-8")
+    response_json = json.loads(raw_response)
+    json.dumps(response_json, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def fast_json_path(raw_request, raw_response, upstream_model):
+    """Fast path: parse once, patch model on raw bytes, pass response bytes through"""
+    body = app.json_loads(raw_request)
+    app.patch_model_field(raw_request, body, body["model"], upstream_model)
+
+
+def measure_cpu(func, iterations, *args):
+    """Return average CPU milliseconds per call"""
+    start = time.process_time()
+    for _ in range(iterations):
+        func(*args)
+    return (time.process_time() - start) * 1000 / iterations
+
+
+def run_json_benchmark(args):
+    upstream_model = "deepseek-ai/deepseek-v3.1-maas"
+    print(f"JSON backend: {'orjson' if app.orjson is not None else 'stdlib json'}")
+    print(f"{'payload':>10} {'legacy ms':>10} {'fast ms':>10} {'speedup':>8}")
+
+    for size in JSON_PAYLOAD_SIZES:
+        raw_request = build_chat_request(size)
+        raw_response = build_chat_response(size // 4)
+        iterations = max(3, min(args.iterations, int(args.iterations * 100_000 / size)))
+
+        legacy_ms = measure_cpu(legacy_json_path, iterations, raw_request, raw_response, upstream_model)
+        fast_ms = measure_cpu(fast_json_path, iterations, raw_request, raw_response, upstream_model)
+        speedup = legacy_ms / fast_ms if fast_ms else float("inf")
+        print(f"{len(raw_request) // 1000:>8}KB {legacy_ms:>10.3f} {fast_ms:>10.3f} {speedup:>7.1f}x")
+
+
+def run_tokens_benchmark(args):
+    count_tokens = app.get_tokenizer("deepseek")
+    turn_text = "Explain the trade-offs of regional failover for LLM inference. " * 40
+    print(f"{'messages':>9} {'chars':>11} {'est tokens':>11} {'ms':>8} {'us/msg':>7} {'check ms':>9}")
+
+    for turns in TOKEN_CONVERSATION_TURNS:
+        messages = [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": turn_text * (1 + i % 20)}
+            for i in range(turns)
+        ]
+        chars = sum(len(message["content"]) for message in messages)
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            prompt_tokens = sum(app.estimate_message_tokens(message, count_tokens) for message in messages)
+        elapsed_ms = (time.perf_counter() - start) * 1000 / args.iterations
+
+        # Full pre-flight check, including the byte-count short-circuit for bodies that obviously fit
+        body = {"model": "deepseek-v3", "messages": messages}
+        body_bytes = len(json.dumps(body))
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            try:
+                app.enforce_context_budget("deepseek-v3", body, body_bytes)
+            except ValueError:
+                pass
+        check_ms = (time.perf_counter() - start) * 1000 / args.iterations
+        print(f"{turns:>9} {chars:>11} {int(prompt_tokens):>11} {elapsed_ms:>8.2f} {elapsed_ms * 1000 / turns:>7.1f} {check_ms:>9.3f}")
+
+
+def run_usage_benchmark(args):
+    from types import SimpleNamespace
+
+    request = SimpleNamespace(
+        headers={"x-user-id": "bench-user"},
+        state=SimpleNamespace(
+            started_at=time.perf_counter(), model_id="deepseek-v3", upstream_model="deepseek-ai/deepseek-v3.1-maas",
+            vertex_region="us-west2", stream=False, estimated_prompt_tokens=1000, attempts=1
+        )
+    )
+    app.USAGE_CONFIG["enabled"] = True
+    app.USAGE_CONFIG["max_buffer"] = args.iterations + 1
+    raw_response = build_chat_response(100_000)
+
+    start = time.perf_counter()
+    for _ in range(args.iterations):
+        app.record_usage(request, 200, app.extract_usage(raw_response))
+    elapsed_us = (time.perf_counter() - start) * 1_000_000 / args.iterations
+    print(f"extract_usage + record_usage (100KB response): {elapsed_us:.1f}us per request")
+    app.usage_buffer.clear()
+
+
+def measure_import_ms(env):
+    """Import app.py in a fresh interpreter and return the import time in ms"""
+    code = "import time; start = time.perf_counter(); import app; print((time.perf_counter() - start) * 1000)"
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+async def measure_cold_start(env):
+    """Start the proxy and return (ms until /ready is 200, ms until the first successful request)"""
+    import httpx
+    import replay
+
+    proxy_port = replay.free_port()
+    proxy_url = f"http://127.0.0.1:{proxy_port}"
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(proxy_port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    ready_ms = None
+    first_request_ms = None
+    body = {"model": "deepseek-v3", "messages": [{"role": "user", "content": "hi"}], "user": "startup"}
+
+    try:
+        async with httpx.AsyncClient(timeout=30.0) as client:
+            while (ready_ms is None or first_request_ms is None) and time.perf_counter() - started < 30:
+                try:
+                    if ready_ms is None and (await client.get(f"{proxy_url}/ready")).status_code == 200:
+                        ready_ms = (time.perf_counter() - started) * 1000
+                    if first_request_ms is None and (await client.post(f"{proxy_url}/v1/chat/completions", json=body)).status_code == 200:
+                        first_request_ms = (time.perf_counter() - started) * 1000
+                except httpx.HTTPError:
+                    await asyncio.sleep(0.01)
+    finally:
+        process.terminate()
+        process.wait()
+
+    return ready_ms, first_request_ms
+
+
+async def run_startup_benchmark_async(args):
+    import uvicorn
+    import replay
+
+    record = {**replay.SYNTHETIC_DEFAULTS, "replay_id": "startup", "stream": False, "ttfb_ms": 0, "response_bytes": 500}
+    mock_port = replay.free_port()
+    mock_server = uvicorn.Server(uvicorn.Config(
+        replay.create_mock_upstream([record], 1.0), host="127.0.0.1", port=mock_port, log_level="warning"
+    ))
+    mock_task = asyncio.create_task(mock_server.serve())
+    while not mock_server.started:
+        await asyncio.sleep(0.01)
+
+    env = {
+        **os.environ,
+        "UPSTREAM_URL_OVERRIDE": f"http://127.0.0.1:{mock_port}/v1/chat/completions",
+        "STATIC_ACCESS_TOKEN": "benchmark",
+        "USAGE_ENABLED": "false",
+        "HEALTH_PROBE_MODE": "off",
+        "OCR_ENABLED": "true" if args.ocr else "false"
+    }
+
+    import_times = [measure_import_ms(env) for _ in range(args.runs)]
+    cold_starts = [await measure_cold_start(env) for _ in range(args.runs)]
+    mock_server.should_exit = True
+    await mock_task
+
+    ready_times = [ready for ready, _ in cold_starts if ready is not None]
+    first_request_times = [first for _, first in cold_starts if first is not None]
+    print(f"OCR enabled: {args.ocr} ({args.runs} runs, median)")
+    print(f"Import app.py:              {statistics.median(import_times):8.1f} ms")
+    if ready_times:
+        print(f"Process start -> /ready:    {statistics.median(ready_times):8.1f} ms")
+    if first_request_times:
+        print(f"Process start -> first 200: {statistics.median(first_request_times):8.1f} ms")
+
+
+def run_startup_benchmark(args):
+    asyncio.run(run_startup_benchmark_async(args))
+
+
+def create_mock_ocr_upstream(base_ms, page_ms):
+    """Mock DeepSeek OCR endpoint: latency is base_ms plus page_ms per image in the request"""
+    from fastapi import FastAPI, Request
+
+    mock = FastAPI()
+
+    @mock.post("/{path:path}")
+    async def chat_completions(request: Request, path: str):
+        body = await request.json()
+        images = [
+            item["image_url"]
+            for message in body["messages"] if isinstance(message.get("content"), list)
+            for item in message["content"] if item.get("type") == "image_url"
+        ]
+        await asyncio.sleep((base_ms + page_ms * len(images)) / 1000)
+        return {
+            "id": "chatcmpl-ocr-mock",
+            "object": "chat.completion",
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "\n\n".join(f"Text of {image}" for image in images)},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 800 * len(images), "completion_tokens": 400 * len(images), "total_tokens": 1200 * len(images)}
+        }
+
+    return mock
+
+
+async def measure_ocr_latency(proxy_url, pages, stream):
+    """Send one OCR request; return (ms to first page of text, ms to complete response)"""
+    import httpx
+
+    body = {
+        "model": "deepseek-ocr",
+        "stream": stream,
+        "messages": [{
+            "role": "user",
+            "content": [{"type": "image_url", "image_url": {"url": f"gs://benchmark/page-{page}.png"}} for page in range(1, pages + 1)]
+        }]
+    }
+    started = time.perf_counter()
+    first_page_ms = None
+    async with httpx.AsyncClient(timeout=600.0) as client:
+        async with client.stream("POST", f"{proxy_url}/v1/chat/completions", json=body) as response:
+            async for line in response.aiter_lines():
+                if first_page_ms is None and '"content":"Text of' in line:
+                    first_page_ms = (time.perf_counter() - started) * 1000
+            response.raise_for_status()
+    return first_page_ms, (time.perf_counter() - started) * 1000
+
+
+async def run_ocr_benchmark_async(args):
+    import httpx
+    import uvicorn
+    import replay
+
+    mock_port = replay.free_port()
+    mock_server = uvicorn.Server(uvicorn.Config(
+        create_mock_ocr_upstream(args.base_ms, args.page_ms), host="127.0.0.1", port=mock_port, log_level="warning"
+    ))
+    mock_task = asyncio.create_task(mock_server.serve())
+    while not mock_server.started:
+        await asyncio.sleep(0.01)
+
+    print(f"Mock OCR latency: {args.base_ms}ms + {args.page_ms}ms per page, fan-out concurrency {args.concurrency} ({args.runs} runs, median)")
+    print(f"{'pages':>6} {'single ms':>10} {'fan-out ms':>11} {'stream 1st page ms':>19} {'stream total ms':>16} {'speedup':>8}")
+
+    results = {}
+    for fanout in (False, True):
+        proxy_port = replay.free_port()
+        proxy_url = f"http://127.0.0.1:{proxy_port}"
+        env = {
+            **os.environ,
+            "UPSTREAM_URL_OVERRIDE": f"http://127.0.0.1:{mock_port}/v1/chat/completions",
+            "STATIC_ACCESS_TOKEN": "benchmark",
+            "USAGE_ENABLED": "false",
+            "HEALTH_PROBE_MODE": "off",
+            "OCR_ENABLED": "true",
+            "OCR_PAGE_FANOUT": "true" if fanout else "false",
+            "OCR_MAX_CONCURRENCY": str(args.concurrency)
+        }
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(proxy_port), "--log-level", "warning"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            async with httpx.AsyncClient() as client:
+                while True:
+                    try:
+                        if (await client.get(f"{proxy_url}/ready")).status_code == 200:
+                            break
+                    except httpx.HTTPError:
+                        pass
+                    await asyncio.sleep(0.05)
+
+            for pages in OCR_PAGE_COUNTS:
+                results[(fanout, pages, False)] = [await measure_ocr_latency(proxy_url, pages, False) for _ in range(args.runs)]
+                if fanout:
+                    results[(fanout, pages, True)] = [await measure_ocr_latency(proxy_url, pages, True) for _ in range(args.runs)]
+        finally:
+            process.terminate()
+            process.wait()
+
+    mock_server.should_exit = True
+    await mock_task
+
+    for pages in OCR_PAGE_COUNTS:
+        single_ms = statistics.median(total for _, total in results[(False, pages, False)])
+        fanout_ms = statistics.median(total for _, total in results[(True, pages, False)])
+        stream_first_ms = statistics.median(first for first, _ in results[(True, pages, True)])
+        stream_total_ms = statistics.median(total for _, total in results[(True, pages, True)])
+        print(f"{pages:>6} {single_ms:>10.0f} {fanout_ms:>11.0f} {stream_first_ms:>19.0f} {stream_total_ms:>16.0f} {single_ms / fanout_ms:>7.1f}x")
+
+
+def run_ocr_benchmark(args):
+    asyncio.run(run_ocr_benchmark_async(args))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vertex AI proxy microbenchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    json_parser = subparsers.add_parser("json", help="CPU cost of request/response JSON handling")
+    json_parser.add_argument("--iterations", type=int, default=200, help="Iterations for the smallest payload")
+    json_parser.set_defaults(func=run_json_benchmark)
+
+    tokens_parser = subparsers.add_parser("tokens", help="Pre-flight token estimation cost")
+    tokens_parser.add_argument("--iterations", type=int, default=5, help="Iterations per conversation size")
+    tokens_parser.set_defaults(func=run_tokens_benchmark)
+
+    usage_parser = subparsers.add_parser("usage", help="Hot-path cost of usage accounting")
+    usage_parser.add_argument("--iterations", type=int, default=10000, help="Recorded requests")
+    usage_parser.set_defaults(func=run_usage_benchmark)
+
+    startup_parser = subparsers.add_parser("startup", help="Cold start: import time and time to first request")
+    startup_parser.add_argument("--runs", type=int, default=5, help="Cold starts to measure")
+    startup_parser.add_argument("--ocr", action="store_true", help="Keep DeepSeek OCR (and GCS) enabled")
+    startup_parser.set_defaults(func=run_startup_benchmark)
+
+    ocr_parser = subparsers.add_parser("ocr", help="Multi-page OCR latency: single request vs per-page fan-out")
+    ocr_parser.add_argument("--runs", type=int, default=3, help="Requests per document size")
+    ocr_parser.add_argument("--base-ms", type=float, default=300, help="Mock upstream latency per request")
+    ocr_parser.add_argument("--page-ms", type=float, default=200, help="Mock upstream latency per page")
+    ocr_parser.add_argument("--concurrency", type=int, default=8, help="OCR_MAX_CONCURRENCY for the fan-out proxy")
+    ocr_parser.set_defaults(func=run_ocr_benchmark)
+
+    args = parser.parse_args()
+    args.func(args)
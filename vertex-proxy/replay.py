@@ -0,0 +1,331 @@
+# vertex-proxy/replay.py
+# Replay captured traffic through the proxy against a local mock upstream
+# Used for offline performance regression testing - no GCP credentials or network needed
+#
+# Usage:
+#   CAPTURE_ENABLED=true python app.py                     # Record traffic to /tmp/vertex-proxy-capture.jsonl
+#   python replay.py /tmp/vertex-proxy-capture.jsonl       # Replay at original speed
+#   python replay.py capture.jsonl --speed 4               # 4x faster arrivals and stream timing
+#   python replay.py ../requests.jsonl --interval 0.5      # Synthetic workload from {"body": ...} JSONL lines
+#
+# The mock upstream reproduces each request's recorded upstream status sequence
+# (e.g. 503 then 200), time to first byte, inter-chunk gaps and response size.
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+PROXY_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Defaults for synthetic records built from {"body": ...} lines (e.g. the repo's requests.jsonl)
+SYNTHETIC_DEFAULTS = {
+    "model": "deepseek-v3",
+    "stream": True,
+    "messages": 1,
+    "upstream_statuses": [{"region": "mock", "status": 200}],
+    "status": 200,
+    "response_bytes": 4000,
+    "ttfb_ms": 300.0,
+    "chunk_gaps_ms": [25.0] * 40
+}
+
+
+def load_workload(path, interval):
+    """
+    Load replay records from a capture file (or any JSONL with "body" text)
+
+    Returns:
+        list of records sorted by arrival, each with "replay_id" and "offset" (seconds)
+    """
+    records = []
+    with open(path, "r", encoding="utf-8") as workload_file:
+        for line_number, line in enumerate(workload_file):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+
+            if "request_bytes" not in record:
+                # Synthetic record: payload size from the body text, fixed arrival interval
+                text = str(record.get("body", ""))
+                record = {**SYNTHETIC_DEFAULTS, "request_bytes": len(text.encode("utf-8")), "ts": line_number * interval}
+
+            record["replay_id"] = f"replay-{line_number}"
+            records.append(record)
+
+    records.sort(key=lambda record: record.get("ts") or 0)
+    first_ts = (records[0].get("ts") or 0) if records else 0
+    for record in records:
+        record["offset"] = (record.get("ts") or 0) - first_ts
+    return records
+
+
+def build_request_body(record):
+    """Build a chat request with the recorded shape (model, size, message count, stream)"""
+    message_count = max(1, record.get("messages") or 1)
+    filler_chars = max(1, (record.get("request_bytes") or 0) - 100 - 40 * message_count)
+    words = "replay " * (filler_chars // (7 * message_count) + 1)
+
+    body = {
+        "model": record["model"],
+        "messages": [
+            {"role": "user" if i % 2 == 0 else "assistant", "content": words}
+            for i in range(message_count - 1)
+        ] + [{"role": "user", "content": words}],
+        "stream": bool(record.get("stream")),
+        "user": record["replay_id"]  # Lets the mock upstream find the record
+    }
+    if record.get("max_tokens"):
+        body["max_tokens"] = record["max_tokens"]
+    return body
+
+
+def create_mock_upstream(records, speed):
+    """Create a mock Vertex AI endpoint that replays recorded statuses and timing"""
+    records_by_id = {record["replay_id"]: record for record in records}
+    attempts = collections.Counter()
+    mock = FastAPI()
+
+    @mock.post("/{path:path}")
+    async def chat_completions(request: Request, path: str):
+        body = await request.json()
+        record = records_by_id.get(body.get("user"), SYNTHETIC_DEFAULTS)
+
+        attempt = attempts[body.get("user")]
+        attempts[body.get("user")] += 1
+        statuses = [entry.get("status") or 503 for entry in record.get("upstream_statuses") or []]
+        statuses = statuses or [record.get("status") or 200]
+        status = statuses[min(attempt, len(statuses) - 1)]
+
+        if status != 200:
+            await asyncio.sleep(0.05 / speed)
+            return JSONResponse(status_code=status, content={"error": {"code": status, "message": "replayed upstream error"}})
+
+        await asyncio.sleep((record.get("ttfb_ms") or 0) / 1000 / speed)
+        usage = {
+            "prompt_tokens": record.get("prompt_tokens") or 0,
+            "completion_tokens": record.get("completion_tokens") or 0,
+            "total_tokens": (record.get("prompt_tokens") or 0) + (record.get("completion_tokens") or 0)
+        }
+
+        if not body.get("stream"):
+            content = "x" * max(0, (record.get("response_bytes") or 0) - 200)
+            return JSONResponse(content={
+                "id": body.get("user"),
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage
+            })
+
+        gaps = record.get("chunk_gaps_ms") or []
+        chunk_chars = max(1, (record.get("response_bytes") or 0) // (len(gaps) + 1) - 80)
+
+        async def generate():
+            chunk = {"choices": [{"index": 0, "delta": {"content": "x" * chunk_chars}}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+            for gap in gaps:
+                await asyncio.sleep(gap / 1000 / speed)
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    return mock
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile (None for an empty list)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def send_request(client, proxy_url, record, start, speed, results):
+    """Send one replayed request at its scheduled time and record client-side latency"""
+    await asyncio.sleep(max(0.0, start + record["offset"] / speed - time.perf_counter()))
+    body = build_request_body(record)
+    sent_at = time.perf_counter()
+    ttfb = None
+    status = None
+
+    try:
+        async with client.stream("POST", f"{proxy_url}/v1/chat/completions", json=body) as response:
+            status = response.status_code
+            async for _ in response.aiter_bytes():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - sent_at
+    except httpx.HTTPError as e:
+        print(f"Replay request {record['replay_id']} failed: {e}")
+
+    results.append({
+        "model": record["model"],
+        "status": status,
+        "recorded_status": record.get("status"),
+        "ttfb_ms": ttfb * 1000 if ttfb is not None else None,
+        "latency_ms": (time.perf_counter() - sent_at) * 1000,
+        "recorded_latency_ms": record.get("latency_ms")
+    })
+
+
+def summarize(results):
+    """
+    Latency distribution per model plus an "all" row
+
+    Requests captured before the model was known (invalid JSON, unknown model)
+    have no model and are grouped under "unknown".
+    """
+    groups = collections.defaultdict(list)
+    for result in results:
+        groups[result["model"] or "unknown"].append(result)
+    groups["all"] = list(results)
+
+    summary = {}
+    for model, group in groups.items():
+        latencies = [result["latency_ms"] for result in group]
+        ttfbs = [result["ttfb_ms"] for result in group if result["ttfb_ms"] is not None]
+        recorded = [result["recorded_latency_ms"] for result in group if result["recorded_latency_ms"] is not None]
+        summary[model] = {
+            "requests": len(group),
+            "errors": sum(1 for result in group if result["status"] != 200),
+            "status_mismatches": sum(
+                1 for result in group
+                if result["recorded_status"] is not None and result["status"] != result["recorded_status"]
+            ),
+            "ttfb_p50_ms": percentile(ttfbs, 0.5),
+            "ttfb_p99_ms": percentile(ttfbs, 0.99),
+            "latency_p50_ms": percentile(latencies, 0.5),
+            "latency_p90_ms": percentile(latencies, 0.9),
+            "latency_p99_ms": percentile(latencies, 0.99),
+            "recorded_latency_p50_ms": percentile(recorded, 0.5)
+        }
+    return summary
+
+
+def print_summary(summary, resources):
+    def fmt(value):
+        return f"{value:.1f}" if value is not None else "-"
+
+    print(f"{'model':<18} {'reqs':>5} {'errs':>5} {'ttfb p50':>9} {'p50':>8} {'p90':>8} {'p99':>8} {'recorded p50':>13}")
+    for model, row in summary.items():
+        print(
+            f"{str(model):<18} {row['requests']:>5} {row['errors']:>5} {fmt(row['ttfb_p50_ms']):>9} "
+            f"{fmt(row['latency_p50_ms']):>8} {fmt(row['latency_p90_ms']):>8} {fmt(row['latency_p99_ms']):>8} "
+            f"{fmt(row['recorded_latency_p50_ms']):>13}"
+        )
+    if resources:
+        print(f"Proxy CPU: {resources['cpu_seconds']:.2f}s, max RSS: {resources['max_rss_mb']:.1f}MB")
+
+
+async def run_replay(args):
+    records = load_workload(args.workload, args.interval)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print("No records to replay")
+        return
+
+    mock_port = args.mock_port or free_port()
+    mock_server = uvicorn.Server(uvicorn.Config(
+        create_mock_upstream(records, args.speed), host="127.0.0.1", port=mock_port, log_level="warning"
+    ))
+    mock_task = asyncio.create_task(mock_server.serve())
+
+    proxy_process = None
+    proxy_url = args.proxy_url
+    usage_dir = tempfile.mkdtemp(prefix="vertex-proxy-replay-")
+    if not proxy_url:
+        proxy_port = free_port()
+        proxy_url = f"http://127.0.0.1:{proxy_port}"
+        env = {
+            **os.environ,
+            "UPSTREAM_URL_OVERRIDE": f"http://127.0.0.1:{mock_port}/v1/chat/completions",
+            "STATIC_ACCESS_TOKEN": "replay",
+            "USAGE_DB_PATH": os.path.join(usage_dir, "usage.sqlite3"),
+            "CAPTURE_ENABLED": "false",
+            "HEALTH_PROBE_MODE": "off"  # Synthetic probes would hit the mock and skew CPU/RSS
+        }
+        proxy_process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(proxy_port), "--log-level", "warning"],
+            cwd=PROXY_DIR,
+            env=env,
+            stdout=subprocess.DEVNULL if not args.verbose else None,
+            stderr=subprocess.DEVNULL if not args.verbose else None
+        )
+
+    results = []
+    try:
+        async with httpx.AsyncClient(timeout=600.0) as client:
+            # Wait for the proxy warm-up (and mock upstream) to complete
+            for _ in range(100):
+                try:
+                    if (await client.get(f"{proxy_url}/ready")).status_code == 200 and mock_server.started:
+                        break
+                except httpx.HTTPError:
+                    pass
+                await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError(f"Proxy at {proxy_url} did not become ready")
+
+            print(f"Replaying {len(records)} request(s) at {args.speed}x speed against {proxy_url}")
+            start = time.perf_counter()
+            await asyncio.gather(*[
+                send_request(client, proxy_url, record, start, args.speed, results)
+                for record in records
+            ])
+            print(f"Replay finished in {time.perf_counter() - start:.1f}s")
+    finally:
+        resources = None
+        if proxy_process is not None:
+            proxy_process.terminate()
+            proxy_process.wait()
+            # Proxy was the only waited-for child, so RUSAGE_CHILDREN is its usage
+            usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+            resources = {
+                "cpu_seconds": usage.ru_utime + usage.ru_stime,
+                "max_rss_mb": usage.ru_maxrss / 1024
+            }
+        mock_server.should_exit = True
+        await mock_task
+
+    summary = summarize(results)
+    print_summary(summary, resources)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({"summary": summary, "resources": resources, "results": results}, output_file, indent=2)
+        print(f"Wrote report to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay captured traffic through the Vertex AI proxy against a mock upstream")
+    parser.add_argument("workload", help="Capture JSONL file (or JSONL with a 'body' text field per line)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Speed multiplier for arrivals and upstream timing")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between synthetic requests (non-capture input)")
+    parser.add_argument("--limit", type=int, default=0, help="Replay only the first N requests")
+    parser.add_argument("--proxy-url", help="Use an already running proxy instead of starting one")
+    parser.add_argument("--mock-port", type=int, default=0, help="Mock upstream port (point UPSTREAM_URL_OVERRIDE of --proxy-url here)")
+    parser.add_argument("--output", help="Write the full report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Show proxy output")
+    args = parser.parse_args()
+
+    asyncio.run(run_replay(args))